@@ -0,0 +1,391 @@
+# bench.py — замеры слоя хранения и отправки бота (запуск: python bench.py <сценарий> --help)
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+import main_emoji as bot_main
+
+
+def _fake_user(uid: int) -> dict:
+    return {
+        "balance": random.randint(0, 10_000),
+        "stars": random.randint(0, 100),
+        "purchases": [],
+        "username": f"user{uid}",
+        "name": f"User {uid}",
+        "tickets": [],
+        "banned": False,
+        "warns": {}
+    }
+
+
+def _report(title: str, samples: list[float]):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{title:<28} mean {statistics.mean(samples) * 1000:8.2f} ms   "
+          f"p50 {statistics.median(samples) * 1000:8.2f} ms   p95 {p95 * 1000:8.2f} ms")
+
+
+# ====================== AUTOSAVE: connect() на вызов против общего соединения ======================
+async def _legacy_autosave(path: str):
+    # Так autosave() работал раньше: каждый хелпер открывает своё соединение
+    tables = (
+        ("users", bot_main.users.cache, "user_id"),
+        ("products", bot_main.products, "product_id"),
+        ("tickets", bot_main.tickets, "ticket_id"),
+        ("raffles", bot_main.raffles, "raffle_id"),
+        ("banned_users", bot_main.banned_users, "user_id"),
+        ("group_data", bot_main.group_data, "chat_id"),
+        ("pending_autoposts", bot_main.pending_autoposts, "post_id"),
+        ("admins", bot_main.admins, "user_id"),
+    )
+    for table, data, key_col in tables:
+        changed, deleted = data.drain()
+        async with aiosqlite.connect(path) as db:
+            for key, value, *_ in changed:
+                await db.execute(
+                    f"INSERT INTO {table} ({key_col}, data) VALUES (?, ?) "
+                    f"ON CONFLICT({key_col}) DO UPDATE SET data = excluded.data",
+                    (key, json.dumps(value, ensure_ascii=False, default=str))
+                )
+            for key in deleted:
+                await db.execute(f"DELETE FROM {table} WHERE {key_col} = ?", (key,))
+            await db.commit()
+    for table, data in (("reviews", bot_main.reviews),
+                        ("channels_required", bot_main.channels_required),
+                        ("autopost_channels", bot_main.autopost_channels)):
+        async with aiosqlite.connect(path) as db:
+            await db.execute(f"DELETE FROM {table}")
+            for item in data:
+                await db.execute(f"INSERT INTO {table} (data) VALUES (?)", (json.dumps(item, ensure_ascii=False, default=str),))
+            await db.commit()
+    for name, value in bot_main.counters.items():
+        async with aiosqlite.connect(path) as db:
+            await db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                (name, value)
+            )
+            await db.commit()
+
+
+async def bench_autosave(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        bot_main.DB_PATH = os.path.join(tmp, "bench.db")
+        await bot_main.init_db()
+        bot_main.users.max_size = args.users
+        for uid in range(args.users):
+            await bot_main.users.create(uid, _fake_user(uid))
+        await bot_main.autosave()
+
+        async def run(label, fn):
+            samples = []
+            for _ in range(args.cycles):
+                for uid in random.sample(range(args.users), args.dirty):
+                    (await bot_main.users.get(uid))["balance"] += 1
+                start = time.perf_counter()
+                await fn()
+                samples.append(time.perf_counter() - start)
+            _report(label, samples)
+
+        print(f"users={args.users} dirty/cycle={args.dirty} cycles={args.cycles}")
+        await run("до: connect() на вызов", lambda: _legacy_autosave(bot_main.DB_PATH))
+        await run("после: общее WAL-соединение", bot_main.autosave)
+        await bot_main.close_db()
+
+
+# ====================== PERSISTENCE: пропускная способность save/load ======================
+async def bench_persistence(args):
+    sizes = [int(x) for x in args.sizes.split(",")]
+    codecs = ["json", "orjson"] if bot_main.orjson is not None else ["json"]
+    print(f"{'кодек':<8} {'users':>9} {'save, rows/s':>14} {'load, rows/s':>14} {'db, MB':>8}")
+    for codec in codecs:
+        bot_main.use_json_codec(codec)
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "bench.db")
+                bot_main.DB_PATH = path
+                await bot_main.init_db()
+
+                # Пишем порциями, чтобы 1M профилей не держать в памяти разом
+                save_time = 0.0
+                for start in range(0, size, args.batch):
+                    table = bot_main.UserTable()
+                    for uid in range(start, min(size, start + args.batch)):
+                        table[uid] = _fake_user(uid)
+                    t0 = time.perf_counter()
+                    await bot_main.flush_users(table)
+                    save_time += time.perf_counter() - t0
+
+                db = await bot_main.open_db()
+                loaded = 0
+                t0 = time.perf_counter()
+                async with db.execute(f"SELECT user_id, {bot_main._USER_COLS_SQL}, data FROM users") as cursor:
+                    while rows := await cursor.fetchmany(args.batch):
+                        for row in rows:
+                            bot_main._user_from_row(row)
+                        loaded += len(rows)
+                load_time = time.perf_counter() - t0
+                await bot_main.close_db()
+
+                size_mb = os.path.getsize(path) / 1024 / 1024
+                print(f"{codec:<8} {size:>9} {size / save_time:>14,.0f} {loaded / load_time:>14,.0f} {size_mb:>8.1f}")
+    bot_main.use_json_codec()
+
+
+# ====================== STARTUP: время до первого polling против размера БД ======================
+async def _fill_startup_db(size: int):
+    # Профиль таблиц примерно как у живого бота: тикетов и отзывов много, остального меньше
+    table = bot_main.UserTable()
+    for uid in range(size):
+        table[uid] = _fake_user(uid)
+    await bot_main.flush_users(table)
+    now = bot_main.datetime.now()
+    for name, key_col, count, make in (
+        ("tickets", "ticket_id", size, lambda i: {"user_id": i, "status": "closed", "topic": "вопрос " * 10, "message_count": 3}),
+        ("raffles", "raffle_id", size // 10, lambda i: {"prize": "100 ₽", "ends_at": now, "participants": list(range(50))}),
+        ("group_data", "chat_id", size // 10, lambda i: {"warns": {str(u): 1 for u in range(5)}, "kicks": {}, "bans": {}, "mutes": {}}),
+        ("products", "product_id", max(1, size // 100), lambda i: {"name": f"Товар {i}", "price": 100, "desc": "описание " * 20}),
+    ):
+        await bot_main.save_dict(name, {i: make(i) for i in range(count)}, key_col)
+    reviews = [(json.dumps({"user_id": i, "text": "отзыв " * 15, "rating": 5}, ensure_ascii=False),) for i in range(size // 2)]
+    async with bot_main.db_transaction() as db:
+        await bot_main.executemany_chunked(db, "INSERT INTO reviews (data) VALUES (?)", reviews)
+
+
+async def _legacy_load_all():
+    # Так load_all_data() работал раньше: таблица за таблицей, fetchall целиком
+    await bot_main.init_db()
+    await bot_main.ledger.replay()
+    for table, key_col, target in (
+        ("products", "product_id", bot_main.products),
+        ("tickets", "ticket_id", bot_main.tickets),
+        ("raffles", "raffle_id", bot_main.raffles),
+        ("banned_users", "user_id", bot_main.banned_users),
+        ("group_data", "chat_id", bot_main.group_data),
+        ("pending_autoposts", "post_id", bot_main.pending_autoposts),
+        ("admins", "user_id", bot_main.admins),
+    ):
+        db = await bot_main.open_db()
+        async with db.execute(f"SELECT {key_col}, data FROM {table}") as cursor:
+            rows = await cursor.fetchall()
+        target.load({key: bot_main.decode_record(table, bot_main.json_loads(raw)) for key, raw in rows})
+    for table, target in (("reviews", bot_main.reviews),
+                          ("channels_required", bot_main.channels_required),
+                          ("autopost_channels", bot_main.autopost_channels)):
+        db = await bot_main.open_db()
+        async with db.execute(f"SELECT id, data FROM {table} ORDER BY id") as cursor:
+            rows = await cursor.fetchall()
+        target.load([(row[0], bot_main.json_loads(row[1])) for row in rows])
+    for name in ("product", "ticket", "raffle", "autopost"):
+        bot_main.counters[name] = await bot_main.load_counter(name, 1)
+
+
+def _count_read_connections() -> dict:
+    """Подменяет read_connection счётчиком: сколько отдельных чтений и сколько шло одновременно."""
+    stats = {"opened": 0, "active": 0, "peak": 0}
+    original = bot_main.read_connection
+
+    @asynccontextmanager
+    async def counted():
+        stats["opened"] += 1
+        stats["active"] += 1
+        stats["peak"] = max(stats["peak"], stats["active"])
+        try:
+            async with original() as conn:
+                yield conn
+        finally:
+            stats["active"] -= 1
+
+    bot_main.read_connection = counted
+    return stats
+
+
+async def bench_startup(args):
+    sizes = [int(x) for x in args.sizes.split(",")]
+    bot_main.use_backend(bot_main.SqliteBackend())
+    reads = _count_read_connections()
+    print(f"{'size':>9} {'db, MB':>8} {'до, мс':>10} {'после, мс':>10} {'чтений одновременно':>20}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            bot_main.DB_PATH = os.path.join(tmp, "bench.db")
+            await bot_main.init_db()
+            await _fill_startup_db(size)
+            await bot_main.close_db()
+            size_mb = os.path.getsize(bot_main.DB_PATH) / 1024 / 1024
+
+            async def run(load):
+                samples = []
+                for _ in range(args.repeat):
+                    # Время до первого polling: открыть БД и загрузить всё, что грузит main()
+                    start = time.perf_counter()
+                    try:
+                        await bot_main.open_db()
+                        await load()
+                        samples.append(time.perf_counter() - start)
+                    finally:
+                        await bot_main.close_db()
+                return statistics.median(samples) * 1000
+
+            before = await run(_legacy_load_all)
+            reads["peak"] = 0
+            after = await run(bot_main.load_all_data)
+            # Параллельная загрузка должна реально идти через read_connection, иначе замер «после» не про неё
+            assert reads["peak"] > 1, "load_all_data не открыл параллельных соединений на чтение"
+            print(f"{size:>9} {size_mb:>8.1f} {before:>10.1f} {after:>10.1f} {reads['peak']:>20}")
+
+
+# ====================== BACKENDS: SQLite против памяти на нагрузке хендлеров ======================
+async def _handler_workload(args) -> tuple[float, list[float]]:
+    # То же, что делают хендлеры: профиль, списание/начисление, покупка, тикет, отзыв
+    samples = []
+    ops = 0
+    start = time.perf_counter()
+    for cycle in range(args.cycles):
+        for _ in range(args.ops):
+            uid = random.randrange(args.users)
+            user = await bot_main.users.get(uid)
+            bot_main.change_balance(uid, user, "balance", -1, "bench")
+            user["purchases"].append({"product": 1, "price": 1})
+            if random.random() < 0.1:
+                t_id = bot_main.counters["ticket"]
+                bot_main.counters["ticket"] += 1
+                bot_main.tickets[t_id] = {"id": t_id, "user_id": uid, "name": user["name"], "message_count": 0, "open": True}
+                await bot_main.add_ticket_message(t_id, "user", "помогите", "01.01 10:00")
+            if random.random() < 0.05:
+                bot_main.reviews.append({"user_id": uid, "text": "отлично", "rating": 5})
+            ops += 1
+        t0 = time.perf_counter()
+        await bot_main.autosave()
+        samples.append(time.perf_counter() - t0)
+    await bot_main.ledger.flush()
+    return ops / (time.perf_counter() - start), samples
+
+
+async def bench_backends(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"users={args.users} cache={args.cache} ops/cycle={args.ops} cycles={args.cycles}")
+        for name, make in (("sqlite", bot_main.SqliteBackend), ("memory", bot_main.InMemoryBackend)):
+            bot_main.DB_PATH = os.path.join(tmp, f"{name}.db")
+            bot_main.use_backend(make())
+            bot_main.users = bot_main.UserRepository(args.cache)
+            await bot_main.load_all_data()
+            table = bot_main.UserTable()
+            for uid in range(args.users):
+                table[uid] = _fake_user(uid)
+            await bot_main.flush_users(table)
+
+            ops_per_sec, samples = await _handler_workload(args)
+            print(f"{name}: {ops_per_sec:,.0f} операций/с")
+            _report(f"{name}: autosave", samples)
+
+            # Холодный старт на том же хранилище
+            bot_main.users = bot_main.UserRepository(args.cache)
+            t0 = time.perf_counter()
+            await bot_main.load_all_data()
+            print(f"{name}: load_all_data {(time.perf_counter() - t0) * 1000:.1f} ms")
+            await bot_main.backend.close()
+    bot_main.use_backend(bot_main.SqliteBackend())
+
+
+# ====================== LANES: ответы пользователям во время рассылки ======================
+async def _fake_request(bot, method, timeout=None):
+    await asyncio.sleep(0.02)   # типичное время ответа Bot API
+    return True
+
+
+async def _lanes_run(args, bulk_lane: str) -> tuple[list[float], float]:
+    bot_main.outbox = bot_main.OutboundQueue()
+    bot_main.api_limiter.__init__(bot_main.API_SEND_RATE)
+
+    async def bulk():
+        with bot_main.in_lane(bulk_lane):
+            await asyncio.gather(*(
+                bot_main.outbox.send("send_message", 1_000_000 + i, "рассылка") for i in range(args.bulk)
+            ))
+
+    async def interactive():
+        samples = []
+        await asyncio.sleep(0.5)   # рассылка уже набрала очередь
+        for i in range(args.replies):
+            t0 = time.perf_counter()
+            # половина — прямые ответы хендлеров, половина — через outbox
+            if i % 2:
+                await bot_main.bot.send_message(i, "ответ")
+            else:
+                await bot_main.outbox.send("send_message", i, "ответ")
+            samples.append(time.perf_counter() - t0)
+            await asyncio.sleep(args.interval)
+        return samples
+
+    start = time.perf_counter()
+    bulk_task = asyncio.create_task(bulk())
+    samples = await interactive()
+    await bulk_task
+    return samples, time.perf_counter() - start
+
+
+async def bench_lanes(args):
+    bot_main.bot.session.make_request = _fake_request
+    print(f"bulk={args.bulk} replies={args.replies} interval={args.interval}s")
+    # «До» — рассылка в той же полосе, что и ответы
+    for title, lane in (("одна полоса", "interactive"), ("bulk-полоса", "bulk")):
+        samples, total = await _lanes_run(args, lane)
+        _report(f"{title}: ответ", samples)
+        print(f"{title}: худший ответ {max(samples) * 1000:.0f} ms, вся рассылка за {total:.1f} с")
+
+
+async def _run_scenario(args):
+    # Упавший сценарий не должен оставить открытое aiosqlite-соединение: его поток не даст процессу выйти
+    try:
+        await args.func(args)
+    finally:
+        await bot_main.close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры слоя хранения и отправки бота")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    p = sub.add_parser("autosave", help="задержка autosave(): соединение на вызов против общего")
+    p.add_argument("--users", type=int, default=10_000)
+    p.add_argument("--dirty", type=int, default=100, help="сколько пользователей меняется за цикл")
+    p.add_argument("--cycles", type=int, default=30)
+    p.set_defaults(func=bench_autosave)
+
+    p = sub.add_parser("persistence", help="save/load rows/s на синтетических пользователях")
+    p.add_argument("--sizes", default="10000,100000,1000000", help="размеры через запятую")
+    p.add_argument("--batch", type=int, default=50_000)
+    p.set_defaults(func=bench_persistence)
+
+    p = sub.add_parser("startup", help="время до первого polling против размера БД")
+    p.add_argument("--sizes", default="1000,10000,100000", help="размеры через запятую")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("backends", help="нагрузка хендлеров на SqliteBackend и InMemoryBackend")
+    p.add_argument("--users", type=int, default=20_000)
+    p.add_argument("--cache", type=int, default=5_000, help="размер LRU пользователей")
+    p.add_argument("--ops", type=int, default=2_000, help="операций между автосейвами")
+    p.add_argument("--cycles", type=int, default=10)
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser("lanes", help="задержка ответов пользователям во время массовой рассылки")
+    p.add_argument("--bulk", type=int, default=300, help="сообщений в рассылке")
+    p.add_argument("--replies", type=int, default=40)
+    p.add_argument("--interval", type=float, default=0.1, help="пауза между ответами, с")
+    p.set_defaults(func=bench_lanes)
+
+    args = parser.parse_args()
+    asyncio.run(_run_scenario(args))
+
+
+if __name__ == "__main__":
+    main()
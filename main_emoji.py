@@ -1,12 +1,19 @@
 # main.py — Полный Telegram Bot для магазина/тикетов/поддержки (aiogram 3.x)
+from abc import ABC, abstractmethod
 import asyncio
+import heapq
+import html
 import logging
 from datetime import datetime, timedelta
 from random import choice
+import os
 import re
+import sqlite3
 import time
+import weakref
+import zlib
 
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode, ChatType
 from aiogram.filters import Command, StateFilter, CommandObject
@@ -18,22 +25,221 @@ from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup,
     FSInputFile, ReplyKeyboardRemove, ChatMember, ChatMemberUpdated
 )
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError,
+)
+from aiogram.methods import EditMessageText, SendAudio, SendDocument, SendMessage, SendPhoto, SendVideo
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import aiosqlite
 import json
-from typing import Any
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
 
 DB_PATH = "bot_database.db"
 
+# ====================== DB CONNECTION ======================
+# Одно долгоживущее соединение на весь процесс (WAL), вместо connect() на каждый вызов.
+_db_conn: aiosqlite.Connection | None = None
+_db_open_lock = asyncio.Lock()
+_db_write_lock = asyncio.Lock()
+
+async def open_db(path: str | None = None) -> aiosqlite.Connection:
+    global _db_conn
+    if _db_conn is not None:
+        return _db_conn
+    async with _db_open_lock:
+        if _db_conn is None:
+            conn = await aiosqlite.connect(path or DB_PATH)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")   # в WAL безопасно и намного быстрее FULL
+            await conn.execute("PRAGMA cache_size=-20000")    # ~20 МБ страничного кэша
+            await conn.execute("PRAGMA temp_store=MEMORY")
+            await conn.execute("PRAGMA busy_timeout=5000")
+            _db_conn = conn
+    return _db_conn
+
+async def close_db():
+    global _db_conn
+    if _db_conn is not None:
+        conn, _db_conn = _db_conn, None
+        await conn.close()
+
+@asynccontextmanager
+async def db_transaction():
+    # Запись из разных корутин идёт по очереди, чтобы commit одной
+    # не зафиксировал половину транзакции другой
+    async with _db_write_lock:
+        db = await open_db()
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+# ====================== JSON CODEC ======================
+# orjson (если установлен) в разы быстрее stdlib json на больших таблицах
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SAVE_CHUNK_SIZE = 5000  # строк на один executemany при массовой записи
+SQL_IN_CHUNK = 500      # id в одном WHERE ... IN (...) — под лимит параметров SQLite
+
+def _stdlib_dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+def _orjson_dumps(value) -> str:
+    return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+json_dumps = _stdlib_dumps
+json_loads = json.loads
+
+def use_json_codec(name: str = "auto") -> str:
+    """Выбирает кодек для колонок data: "orjson", "json" или "auto". Возвращает выбранный."""
+    global json_dumps, json_loads
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name == "orjson":
+        if orjson is None:
+            raise RuntimeError("orjson не установлен")
+        json_dumps, json_loads = _orjson_dumps, orjson.loads
+    else:
+        json_dumps, json_loads = _stdlib_dumps, json.loads
+    return name
+
+use_json_codec()
+
+# ====================== RECORD CODEC ======================
+# Схемы полей, которые не переживают JSON как есть: даты хранятся целым epoch
+# (секунды) и при загрузке сразу превращаются в datetime, а ключи-user_id
+# вложенных словарей возвращаются из строк в int. Разбор — один раз при загрузке.
+DATETIME = "datetime"
+
+class MapOf:
+    """Словарь с произвольными ключами: key — тип ключа, value — схема значений."""
+    __slots__ = ("key", "value")
+
+    def __init__(self, key=None, value=None):
+        self.key = key
+        self.value = value
+
+RECORD_SCHEMAS = {
+    "banned_users": {"until": DATETIME},
+    "tickets": {"closed_at": DATETIME},
+    "raffles": {"ends_at": DATETIME, "finished_at": DATETIME},
+    "group_data": {
+        "warns": MapOf(int),
+        "kicks": MapOf(int),
+        "bans": MapOf(int, {"until": DATETIME}),
+        "mutes": MapOf(int, {"until": DATETIME}),
+    },
+}
+
+def _encode_value(value, spec):
+    if value is None:
+        return None
+    if spec == DATETIME:
+        return int(value.timestamp()) if isinstance(value, datetime) else value
+    if isinstance(spec, MapOf):
+        if spec.value is None or not isinstance(value, dict):
+            return value
+        return {k: _encode_value(v, spec.value) for k, v in value.items()}
+    if isinstance(value, dict):
+        out = dict(value)
+        for field, sub in spec.items():
+            if field in out:
+                out[field] = _encode_value(out[field], sub)
+        return out
+    return value
+
+def _decode_value(value, spec):
+    if value is None:
+        return None
+    if spec == DATETIME:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value)
+        if isinstance(value, str):  # старый формат: str(datetime)
+            try:
+                return datetime.fromisoformat(value)
+            except ValueError:
+                return None
+        return value
+    if isinstance(spec, MapOf):
+        if not isinstance(value, dict):
+            return value
+        out = {}
+        for k, v in value.items():
+            if spec.key is int and isinstance(k, str) and k.lstrip("-").isdigit():
+                k = int(k)
+            out[k] = _decode_value(v, spec.value) if spec.value is not None else v
+        return out
+    if isinstance(value, dict):
+        for field, sub in spec.items():
+            if field in value:
+                value[field] = _decode_value(value[field], sub)
+    return value
+
+def encode_record(table: str, value):
+    """Копия записи для сохранения: datetime → epoch. Живую запись не трогает."""
+    schema = RECORD_SCHEMAS.get(table)
+    return value if schema is None else _encode_value(value, schema)
+
+def decode_record(table: str, value):
+    schema = RECORD_SCHEMAS.get(table)
+    return value if schema is None else _decode_value(value, schema)
+
+async def executemany_chunked(db: aiosqlite.Connection, sql: str, rows: list):
+    """executemany порциями по SAVE_CHUNK_SIZE внутри транзакции вызывающего.
+
+    Порции только ограничивают размер одного вызова: flush пишется целиком или не пишется вовсе.
+    """
+    for start in range(0, len(rows), SAVE_CHUNK_SIZE):
+        await db.executemany(sql, rows[start:start + SAVE_CHUNK_SIZE])
+
+# Пользователи: основные поля — отдельными колонками, остальное (покупки, варны) — в data
+USERS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        balance INTEGER NOT NULL DEFAULT 0,
+        stars INTEGER NOT NULL DEFAULT 0,
+        username TEXT NOT NULL DEFAULT '',
+        name TEXT NOT NULL DEFAULT '',
+        banned INTEGER NOT NULL DEFAULT 0,
+        created INTEGER,
+        last_seen INTEGER,
+        ledger_seq INTEGER NOT NULL DEFAULT 0,
+        unreachable_at INTEGER,
+        data TEXT NOT NULL DEFAULT '{}'
+    )
+'''
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Таблицы с JSON-полем "data"
+    async with db_transaction() as db:
+        await db.execute(USERS_TABLE_SQL)
+        await migrate_users_table(db)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance)")
+
+        # Журнал изменений баланса/звёзд (write-ahead): переигрывается поверх снимка users
         await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                data TEXT NOT NULL DEFAULT '{}'
+            CREATE TABLE IF NOT EXISTS ledger (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                field TEXT NOT NULL,
+                delta INTEGER NOT NULL,
+                reason TEXT NOT NULL DEFAULT '',
+                ts INTEGER NOT NULL
             )
         ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id)")
+
+        # Таблицы с JSON-полем "data"
         await db.execute('''
             CREATE TABLE IF NOT EXISTS products (
                 product_id INTEGER PRIMARY KEY,
@@ -46,12 +252,40 @@ async def init_db():
                 data TEXT NOT NULL
             )
         ''')
+        # Переписка в тикетах: одна строка на сообщение, в tickets — только метаданные
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS ticket_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ticket_id INTEGER NOT NULL,
+                sender TEXT NOT NULL,
+                text TEXT,
+                date TEXT NOT NULL
+            )
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_ticket_messages_ticket ON ticket_messages (ticket_id, id)")
         await db.execute('''
             CREATE TABLE IF NOT EXISTS raffles (
                 raffle_id INTEGER PRIMARY KEY,
                 data TEXT NOT NULL
             )
         ''')
+        # Холодный архив: закрытые тикеты (вместе с перепиской) и завершённые
+        # розыгрыши, data — zlib-сжатый JSON
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS tickets_archive (
+                ticket_id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                closed_at INTEGER,
+                data BLOB NOT NULL
+            )
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS raffles_archive (
+                raffle_id INTEGER PRIMARY KEY,
+                finished_at INTEGER,
+                data BLOB NOT NULL
+            )
+        ''')
         await db.execute('''
             CREATE TABLE IF NOT EXISTS banned_users (
                 user_id INTEGER PRIMARY KEY,
@@ -105,68 +339,1543 @@ async def init_db():
             )
         ''')
 
-        await db.commit()
+        # Рассылки: задание с курсором по user_id и статус доставки каждому
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                audience TEXT NOT NULL DEFAULT 'all',
+                status TEXT NOT NULL DEFAULT 'running',
+                cursor INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                created_by INTEGER,
+                created INTEGER,
+                finished INTEGER
+            )
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                ts INTEGER,
+                PRIMARY KEY (job_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+        async with db.execute("PRAGMA table_info(broadcast_jobs)") as cursor:
+            if "skipped" not in {row[1] for row in await cursor.fetchall()}:
+                await db.execute("ALTER TABLE broadcast_jobs ADD COLUMN skipped INTEGER NOT NULL DEFAULT 0")
 
 # Универсальные функции загрузки/сохранения
+LOAD_CHUNK_SIZE = 2000   # строк за один fetchmany при загрузке
+
+@asynccontextmanager
+async def read_connection():
+    # Отдельное соединение для параллельного чтения при старте: в WAL
+    # читатели не ждут друг друга и общего соединения
+    conn = await aiosqlite.connect(DB_PATH)
+    try:
+        await conn.execute("PRAGMA query_only=ON")
+        yield conn
+    finally:
+        await conn.close()
+
 async def load_dict(table: str, key_col: str = "user_id", dict_global=None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(f"SELECT {key_col}, data FROM {table}") as cursor:
-            rows = await cursor.fetchall()
-            result = {}
-            for row in rows:
-                key = row[0]
-                try:
-                    value = json.loads(row[1])
-                except:
-                    value = {}
-                result[key] = value
-            if dict_global is not None:
-                dict_global.clear()
-                dict_global.update(result)
-            return result
+    started = time.perf_counter()
+    result = {}
+    broken = 0
+    async for rows in backend.iter_dict_rows(table, key_col):
+        for key, raw in rows:
+            try:
+                result[key] = decode_record(table, json_loads(raw))
+            except (TypeError, ValueError):
+                result[key] = {}
+                broken += 1
+    if broken:
+        logging.warning(f"{table}: {broken} строк с битым JSON загружены пустыми")
+    if isinstance(dict_global, TrackedDict):
+        dict_global.load(result)
+    elif dict_global is not None:
+        dict_global.clear()
+        dict_global.update(result)
+    logging.info(f"{table}: загружено {len(result)} строк за {(time.perf_counter() - started) * 1000:.1f} мс")
+    return result
 
 async def save_dict(table: str, data: dict, key_col: str = "user_id"):
-    async with aiosqlite.connect(DB_PATH) as db:
+    await backend.write_dict(
+        table, key_col, [(key, json_dumps(encode_record(table, value))) for key, value in data.items()], []
+    )
+
+async def load_list(table: str, global_list=None):
+    started = time.perf_counter()
+    result = []
+    async for rows in backend.iter_list_rows(table):
+        result.extend((row[0], json_loads(row[1])) for row in rows)
+    if isinstance(global_list, TrackedList):
+        # id удалённых элементов не переиспользуются — берём следующий из хранилища
+        global_list.load(result, next_id=await backend.list_next_id(table))
+    elif global_list is not None:
+        global_list.clear()
+        global_list.extend(value for _, value in result)
+    logging.info(f"{table}: загружено {len(result)} строк за {(time.perf_counter() - started) * 1000:.1f} мс")
+    return result
+
+async def save_counter(name: str, value: int):
+    await backend.save_counters({name: value})
+
+async def load_counter(name: str, default: int) -> int:
+    return (await backend.load_counters({name: default}))[name]
+
+async def load_counters(defaults: dict) -> dict:
+    # Все счётчики одним запросом; отсутствующие получают значение по умолчанию
+    return await backend.load_counters(defaults)
+
+# ====================== DIRTY TRACKING ======================
+# Глобальные словари (users, tickets, ...) запоминают, какие ключи изменились
+# или удалены с прошлого автосейва, чтобы писать в БД только их.
+# Вложенные dict/list оборачиваются: users[uid]["balance"] -= 1 или
+# group_data[chat]["warns"][uid] = 1 помечают грязной запись верхнего уровня.
+
+def _wrap(value, owner, key, field=None):
+    if not isinstance(value, (dict, list)):
+        return value   # скаляры — самый частый случай, особенно при загрузке
+    if (isinstance(value, (_TrackedNode, _TrackedListNode))
+            and value._owner is owner and value._key == key and value._field == field):
+        return value
+    if isinstance(value, dict):
+        node = _TrackedNode()
+        node._owner, node._key, node._field = owner, key, field
+        for k, v in value.items():
+            dict.__setitem__(node, k, _wrap(v, owner, key, k if field is None else field))
+        return node
+    if isinstance(value, list):
+        node = _TrackedListNode()
+        node._owner, node._key, node._field = owner, key, field
+        list.extend(node, [_wrap(v, owner, key, field) for v in value])
+        return node
+    return value
+
+
+class _TrackedNode(dict):
+    """Вложенный dict внутри отслеживаемой записи."""
+    __slots__ = ("_owner", "_key", "_field", "__weakref__")
+
+    def _touch(self, k=None):
+        self._owner._touch(self._key, self._field if self._field is not None else k)
+
+    def _child(self, k, v):
+        return _wrap(v, self._owner, self._key, k if self._field is None else self._field)
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, self._child(k, v))
+        self._touch(k)
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        self._touch(k)
+
+    def pop(self, k, *default):
+        if k in self:
+            self._touch(k)
+        return dict.pop(self, k, *default)
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        self._touch(k)
+        return k, v
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self[k] = default
+        return dict.__getitem__(self, k)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        dict.clear(self)
+        self._touch()
+
+
+class _TrackedListNode(list):
+    """Вложенный list внутри отслеживаемой записи."""
+    __slots__ = ("_owner", "_key", "_field")
+
+    def _touch(self):
+        self._owner._touch(self._key, self._field)
+
+    def _child(self, v):
+        return _wrap(v, self._owner, self._key, self._field)
+
+    def __setitem__(self, i, v):
+        if isinstance(i, slice):
+            v = [self._child(x) for x in v]
+        else:
+            v = self._child(v)
+        list.__setitem__(self, i, v)
+        self._touch()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self._touch()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._touch()
+        return self
+
+    def append(self, v):
+        list.append(self, self._child(v))
+        self._touch()
+
+    def extend(self, values):
+        list.extend(self, [self._child(v) for v in values])
+        self._touch()
+
+    def insert(self, i, v):
+        list.insert(self, i, self._child(v))
+        self._touch()
+
+    def remove(self, v):
+        list.remove(self, v)
+        self._touch()
+
+    def pop(self, *args):
+        v = list.pop(self, *args)
+        self._touch()
+        return v
+
+    def clear(self):
+        list.clear(self)
+        self._touch()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._touch()
+
+    def reverse(self):
+        list.reverse(self)
+        self._touch()
+
+
+class TrackedDict(dict):
+    """Словарь верхнего уровня, который помнит изменённые и удалённые ключи."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._dirty = set()
+        self._deleted = set()
+        self.update(*args, **kwargs)
+
+    def _touch(self, key, field=None):
+        if dict.__contains__(self, key):
+            self._dirty.add(key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, _wrap(value, self, key))
+        self._dirty.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        self._deleted.update(dict.keys(self))
+        self._dirty.clear()
+        dict.clear(self)
+
+    def load(self, data: dict):
+        """Заменяет содержимое данными из БД, ничего не помечая грязным."""
+        dict.clear(self)
         for key, value in data.items():
-            await db.execute(
-                f"INSERT INTO {table} ({key_col}, data) VALUES (?, ?) "
-                f"ON CONFLICT({key_col}) DO UPDATE SET data = excluded.data",
-                (key, json.dumps(value, ensure_ascii=False, default=str))
+            dict.__setitem__(self, key, _wrap(value, self, key))
+        self._dirty.clear()
+        self._deleted.clear()
+
+    def drain(self):
+        """Забирает накопленные изменения: ([(key, value), ...], [deleted_key, ...])."""
+        changed = [(key, dict.__getitem__(self, key)) for key in self._dirty]
+        deleted = list(self._deleted)
+        self._dirty = set()
+        self._deleted = set()
+        return changed, deleted
+
+    def discard(self, key):
+        """Убирает запись из памяти без удаления из БД."""
+        dict.pop(self, key, None)
+        self._dirty.discard(key)
+
+    def requeue(self, changed_keys, deleted_keys):
+        """Возвращает изменения в очередь, если запись в БД не удалась."""
+        for key in changed_keys:
+            if dict.__contains__(self, key):
+                self._dirty.add(key)
+        for key in deleted_keys:
+            if not dict.__contains__(self, key):
+                self._deleted.add(key)
+
+
+async def flush_dict(table: str, data: TrackedDict, key_col: str = "user_id") -> tuple[int, int]:
+    """Пишет в БД только изменённые ключи и удаляет удалённые. Возвращает (записано, удалено)."""
+    changed, deleted = data.drain()
+    if not changed and not deleted:
+        return 0, 0
+    # Сериализуем сразу, пока запись не успели поменять в другом хендлере
+    rows = [(key, json_dumps(encode_record(table, value))) for key, value in changed]
+    try:
+        await backend.write_dict(table, key_col, rows, deleted)
+    except Exception:
+        data.requeue([key for key, _ in changed], deleted)
+        raise
+    return len(rows), len(deleted)
+
+class TrackedList(list):
+    """Список-таблица (reviews, channels_required, ...): у каждого элемента стабильный item["id"] = id строки."""
+
+    def __init__(self):
+        super().__init__()
+        self._by_id = {}
+        self._next_id = 1
+        self._new = set()
+        self._dirty = set()
+        self._deleted = set()
+
+    def _touch(self, key, field=None):
+        if key in self._by_id:
+            self._dirty.add(key)
+
+    def _adopt(self, item):
+        if isinstance(item, _TrackedNode) and item._owner is self and self._by_id.get(item._key) is item:
+            return item
+        item_id = self._next_id
+        self._next_id += 1
+        node = _wrap(item, self, item_id)
+        dict.__setitem__(node, "id", item_id)
+        self._by_id[item_id] = node
+        self._new.add(item_id)
+        self._dirty.add(item_id)
+        return node
+
+    def _forget(self, item):
+        item_id = item.get("id") if isinstance(item, dict) else None
+        if self._by_id.get(item_id) is not item:
+            return
+        del self._by_id[item_id]
+        self._dirty.discard(item_id)
+        if item_id in self._new:
+            self._new.discard(item_id)  # в БД ещё не попал
+        else:
+            self._deleted.add(item_id)
+
+    def _rebuild(self, items):
+        kept = set()
+        new_items = []
+        for item in items:
+            node = self._adopt(item)
+            kept.add(id(node))
+            new_items.append(node)
+        for item in list.__iter__(self):
+            if id(item) not in kept:
+                self._forget(item)
+        list.__setitem__(self, slice(None), new_items)
+
+    def get(self, item_id: int):
+        return self._by_id.get(item_id)
+
+    def pop_id(self, item_id: int):
+        item = self._by_id.get(item_id)
+        if item is not None:
+            self.remove(item)
+        return item
+
+    def append(self, item):
+        list.append(self, self._adopt(item))
+
+    def extend(self, items):
+        list.extend(self, [self._adopt(item) for item in items])
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, i, item):
+        list.insert(self, i, self._adopt(item))
+
+    def remove(self, item):
+        for i, current in enumerate(list.__iter__(self)):
+            if current is item or current == item:
+                list.__delitem__(self, i)
+                self._forget(current)
+                return
+        raise ValueError("TrackedList.remove(x): x not in list")
+
+    def pop(self, i=-1):
+        item = list.pop(self, i)
+        self._forget(item)
+        return item
+
+    def clear(self):
+        self._rebuild([])
+
+    def __setitem__(self, i, value):
+        items = list(list.__iter__(self))
+        items[i] = value
+        self._rebuild(items)
+
+    def __delitem__(self, i):
+        items = list(list.__iter__(self))
+        del items[i]
+        self._rebuild(items)
+
+    def load(self, rows, next_id: int | None = None):
+        """rows: [(id, value), ...] из БД; ничего не помечает грязным."""
+        list.clear(self)
+        self._by_id = {}
+        for item_id, value in rows:
+            node = _wrap(value, self, item_id)
+            dict.__setitem__(node, "id", item_id)
+            self._by_id[item_id] = node
+            list.append(self, node)
+        self._next_id = max(max(self._by_id, default=0) + 1, next_id or 1)
+        self._new.clear()
+        self._dirty.clear()
+        self._deleted.clear()
+
+    def drain(self):
+        """Забирает изменения: ([(id, item), ...] на INSERT/UPDATE, [id, ...] на DELETE)."""
+        changed = [(item_id, self._by_id[item_id]) for item_id in self._dirty]
+        deleted = list(self._deleted)
+        self._new = set()
+        self._dirty = set()
+        self._deleted = set()
+        return changed, deleted
+
+    def requeue(self, changed_ids, deleted_ids):
+        for item_id in changed_ids:
+            if item_id in self._by_id:
+                self._dirty.add(item_id)
+        for item_id in deleted_ids:
+            if item_id not in self._by_id:
+                self._deleted.add(item_id)
+
+
+async def flush_list(table: str, data: TrackedList) -> tuple[int, int]:
+    """Новый элемент — один INSERT, изменённый — UPDATE, удалённый — DELETE по id."""
+    changed, deleted = data.drain()
+    if not changed and not deleted:
+        return 0, 0
+    rows = [
+        (item_id, json_dumps({k: v for k, v in item.items() if k != "id"}))
+        for item_id, item in changed
+    ]
+    try:
+        await backend.write_list(table, rows, deleted)
+    except Exception:
+        data.requeue([item_id for item_id, _ in changed], deleted)
+        raise
+    return len(rows), len(deleted)
+
+# ====================== USERS TABLE ======================
+# ledger_seq — id последней записи журнала, уже учтённой в этой строке;
+# unreachable_at — когда бот получил Forbidden / «chat not found» (NULL — доступен)
+USER_COLUMNS = ("balance", "stars", "username", "name", "banned", "created", "last_seen", "ledger_seq",
+                "unreachable_at")
+_USER_COLS_SQL = ", ".join(USER_COLUMNS)
+_USER_PLACEHOLDERS = ", ".join("?" for _ in USER_COLUMNS)
+
+def _user_column(user: dict, col: str):
+    if col == "data":
+        return json_dumps({k: v for k, v in user.items() if k not in USER_COLUMNS})
+    value = user.get(col)
+    if col in ("balance", "stars", "ledger_seq"):
+        return int(value or 0)
+    if col in ("username", "name"):
+        return value or ""
+    if col == "banned":
+        return 1 if value else 0
+    return value
+
+# Поля профиля вне колонок, без которых хендлеры падают (purchases.append и т.п.)
+USER_DATA_DEFAULTS = {"purchases": [], "tickets": [], "warns": {}}
+
+def new_user_profile(username: str = "", name: str = "") -> dict:
+    now_ts = int(time.time())
+    return {
+        "balance": 0,
+        "stars": 0,
+        "purchases": [],
+        "username": username,
+        "name": name,
+        "tickets": [],
+        "banned": False,
+        "warns": {},
+        "created": now_ts,
+        "last_seen": now_ts
+    }
+
+def _user_from_row(row) -> dict:
+    try:
+        user = json_loads(row[-1])
+    except (TypeError, ValueError):
+        user = {}
+    user.update(zip(USER_COLUMNS, row[1:-1]))
+    user["banned"] = bool(user["banned"])
+    for key, default in USER_DATA_DEFAULTS.items():
+        if key not in user:
+            user[key] = type(default)()
+    return user
+
+async def migrate_users_table(db):
+    """Разовая миграция старой таблицы users(user_id, data JSON) в колоночную схему."""
+    async with db.execute("PRAGMA table_info(users)") as cursor:
+        cols = {row[1] for row in await cursor.fetchall()}
+    if "balance" in cols:
+        if "ledger_seq" not in cols:
+            await db.execute("ALTER TABLE users ADD COLUMN ledger_seq INTEGER NOT NULL DEFAULT 0")
+        if "unreachable_at" not in cols:
+            await db.execute("ALTER TABLE users ADD COLUMN unreachable_at INTEGER")
+        return
+    logging.info("Миграция таблицы users в колоночную схему...")
+    await db.execute("ALTER TABLE users RENAME TO users_legacy")
+    await db.execute(USERS_TABLE_SQL)
+    migrated = 0
+    async with db.execute("SELECT user_id, data FROM users_legacy") as cursor:
+        while rows := await cursor.fetchmany(1000):
+            batch = []
+            for uid, raw in rows:
+                try:
+                    user = json_loads(raw)
+                except (TypeError, ValueError):
+                    user = {}
+                batch.append((uid,) + tuple(_user_column(user, col) for col in USER_COLUMNS + ("data",)))
+            await db.executemany(
+                f"INSERT INTO users (user_id, {_USER_COLS_SQL}, data) VALUES (?, {_USER_PLACEHOLDERS}, ?)",
+                batch
             )
-        await db.commit()
+            migrated += len(batch)
+    await db.execute("DROP TABLE users_legacy")
+    logging.info(f"Миграция users завершена: {migrated} пользователей")
 
-async def load_list(table: str, global_list=None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(f"SELECT data FROM {table} ORDER BY id") as cursor:
-            rows = await cursor.fetchall()
-            result = [json.loads(row[0]) for row in rows]
-            if global_list is not None:
-                global_list.clear()
-                global_list.extend(result)
-            return result
 
-async def save_list(table: str, data: list):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(f"DELETE FROM {table}")
-        for item in data:
-            await db.execute(f"INSERT INTO {table} (data) VALUES (?)", (json.dumps(item, ensure_ascii=False, default=str),))
-        await db.commit()
+class UserTable(TrackedDict):
+    """users: помимо изменённых ключей помнит, какие поля записи поменялись."""
 
+    def __init__(self, *args, **kwargs):
+        self._fields = {}
+        # Вытесненные профили, которые хендлер ещё держит в переменной (user = await users.get(...))
+        self._detached = weakref.WeakValueDictionary()
+        self.on_reattach = None
+        super().__init__(*args, **kwargs)
 
+    def _touch(self, key, field=None):
+        if not dict.__contains__(self, key) and self.reattach(key) is None:
+            return
+        self._dirty.add(key)
+        fields = self._fields.get(key, set())
+        if fields is not None:
+            if field is None:
+                self._fields[key] = None
+            else:
+                fields.add(field)
+                self._fields[key] = fields
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._fields[key] = None
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._fields.pop(key, None)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._fields.pop(key, None)
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self._fields.clear()
+
+    def load(self, data: dict):
+        super().load(data)
+        self._fields.clear()
+
+    def drain(self, keys=None):
+        """([(uid, user, fields | None), ...], [deleted_uid, ...]); None — переписать запись целиком.
+
+        keys — забрать изменения только этих пользователей (запись перед вытеснением из кэша).
+        """
+        if keys is not None:
+            changed = []
+            for key in keys:
+                if key in self._dirty:
+                    self._dirty.discard(key)
+                    changed.append((key, dict.__getitem__(self, key), self._fields.pop(key, None)))
+            return changed, []
+        fields = self._fields
+        changed = [(key, dict.__getitem__(self, key), fields.get(key)) for key in self._dirty]
+        deleted = list(self._deleted)
+        self._dirty = set()
+        self._deleted = set()
+        self._fields = {}
+        return changed, deleted
+
+    def adopt(self, key, value):
+        """Кладёт запись, прочитанную из БД, не помечая её грязной."""
+        dict.__setitem__(self, key, _wrap(value, self, key))
+        return dict.__getitem__(self, key)
+
+    def discard(self, key):
+        super().discard(key)
+        self._fields.pop(key, None)
+
+    def detach(self, key):
+        """Убирает профиль из памяти. Пока на него есть ссылки, запись в него вернёт его обратно."""
+        node = dict.get(self, key)
+        self.discard(key)
+        if node is not None:
+            self._detached[key] = node
+
+    def reattach(self, key):
+        """Возвращает в таблицу вытесненный, но ещё живой профиль; None — такого нет."""
+        node = self._detached.pop(key, None)
+        if node is not None:
+            dict.__setitem__(self, key, node)
+            if self.on_reattach is not None:
+                self.on_reattach(key)
+        return node
+
+    def requeue(self, changed_keys, deleted_keys):
+        super().requeue(changed_keys, deleted_keys)
+        for key in changed_keys:
+            if dict.__contains__(self, key):
+                self._fields[key] = None
+
+
+async def flush_users(data: UserTable, keys=None) -> tuple[int, int]:
+    """Новые пользователи — полный upsert, правки — UPDATE только изменённых колонок."""
+    changed, deleted = data.drain(keys)
+    if not changed and not deleted:
+        return 0, 0
+    full_rows = []
+    partial = {}
+    for uid, user, fields in changed:
+        if fields is None:
+            full_rows.append((uid,) + tuple(_user_column(user, col) for col in USER_COLUMNS + ("data",)))
+        else:
+            cols = tuple(sorted({f if f in USER_COLUMNS else "data" for f in fields}))
+            partial.setdefault(cols, []).append(tuple(_user_column(user, col) for col in cols) + (uid,))
+    try:
+        await backend.write_users(full_rows, partial, deleted)
+    except Exception:
+        data.requeue([uid for uid, _, _ in changed], deleted)
+        raise
+    return len(full_rows) + sum(len(rows) for rows in partial.values()), len(deleted)
 
-async def save_counter(name: str, value: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+
+USER_CACHE_SIZE = 10_000  # сколько профилей держать в памяти
+
+class UserRepository:
+    """Пользователи: профиль читается из хранилища при первом обращении, горячие держатся в LRU.
+
+    Перед вытеснением изменённый профиль записывается в БД.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.cache = UserTable()
+        self.cache.on_reattach = self._touch_lru
+        self._lru = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "writebacks": 0, "reattached": 0}
+
+    def __len__(self):
+        return len(self.cache)
+
+    def _touch_lru(self, user_id: int):
+        self._lru[user_id] = None
+        self._lru.move_to_end(user_id)
+
+    async def get(self, user_id: int, default=None):
+        if dict.__contains__(self.cache, user_id):
+            self.stats["hits"] += 1
+            self._touch_lru(user_id)
+            return dict.__getitem__(self.cache, user_id)
+        # Вытеснен, но другой хендлер ещё держит его — отдаём тот же объект, а не копию из БД
+        if self.cache.reattach(user_id) is not None:
+            self.stats["reattached"] += 1
+            return dict.__getitem__(self.cache, user_id)
+        self.stats["misses"] += 1
+        row = await backend.get_user_row(user_id)
+        if row is None:
+            return default
+        if dict.__contains__(self.cache, user_id):  # пока ждали БД, его уже загрузил другой хендлер
+            return await self.get(user_id, default)
+        user = self.cache.adopt(user_id, _user_from_row(row))
+        self._lru[user_id] = None
+        await self._evict()
+        return user
+
+    async def exists(self, user_id: int) -> bool:
+        return await self.get(user_id) is not None
+
+    async def create(self, user_id: int, user: dict) -> dict:
+        """Новый профиль сразу пишется в БД: журнал балансов может сослаться на него до автосейва."""
+        self.cache[user_id] = user
+        self._lru[user_id] = None
+        self._lru.move_to_end(user_id)
+        await flush_users(self.cache, [user_id])
+        await self._evict()
+        return dict.__getitem__(self.cache, user_id)
+
+    async def flush(self) -> tuple[int, int]:
+        return await flush_users(self.cache)
+
+    # Чтения ниже не сбрасывают грязные профили: новые пишутся сразу в create(),
+    # а несохранённые правки берутся из кэша поверх строк БД.
+    async def count(self) -> int:
+        return await backend.count_users()
+
+    async def page(self, offset: int, limit: int) -> list[tuple[int, dict]]:
+        """Страница пользователей по возрастанию id (для админки); кэш не засоряет."""
+        rows = await backend.user_rows_page(offset, limit)
+        return [
+            (row[0], dict.__getitem__(self.cache, row[0]) if dict.__contains__(self.cache, row[0]) else _user_from_row(row))
+            for row in rows
+        ]
+
+    async def ids_after(self, last_id: int, limit: int) -> list[int]:
+        """Следующие limit user_id после last_id по возрастанию."""
+        return await backend.user_ids_after(last_id, limit)
+
+    async def reach_after(self, last_id: int, limit: int) -> list[tuple[int, int | None]]:
+        """Как ids_after, но с отметкой недоступности: [(user_id, unreachable_at), ...]."""
+        rows = await backend.user_reach_after(last_id, limit)
+        cache = self.cache
+        return [
+            (uid, dict.__getitem__(cache, uid).get("unreachable_at") if dict.__contains__(cache, uid) else marked)
+            for uid, marked in rows
+        ]
+
+    async def reach_of(self, user_ids) -> dict[int, int | None]:
+        """unreachable_at для многих пользователей одним запросом, без загрузки профилей в LRU."""
+        reach = dict(await backend.user_reach_of(list(user_ids)))
+        cache = self.cache
+        for uid in reach:
+            if dict.__contains__(cache, uid):
+                reach[uid] = dict.__getitem__(cache, uid).get("unreachable_at")
+        return reach
+
+    async def iter_ids(self, batch: int = 1000):
+        """Все user_id из БД, порциями по batch (keyset-пагинация)."""
+        last = -1 << 63
+        while True:
+            ids = await backend.user_ids_after(last, batch)
+            if not ids:
+                return
+            for user_id in ids:
+                yield user_id
+            last = ids[-1]
+
+    async def _evict(self):
+        if len(self._lru) <= self.max_size:
+            return
+        victims = []
+        while len(self._lru) > self.max_size:
+            user_id, _ = self._lru.popitem(last=False)
+            victims.append(user_id)
+        self.stats["evictions"] += len(victims)
+        try:
+            written, _ = await flush_users(self.cache, victims)
+            self.stats["writebacks"] += written
+        finally:
+            for user_id in victims:
+                if user_id in self._lru:
+                    continue    # пока писали, профиль снова прочитали — он уже в LRU
+                if user_id in self.cache._dirty:
+                    # Изменён по ссылке во время записи (или запись не удалась): остаётся
+                    # в кэше и возвращается в LRU, чтобы его можно было вытеснить позже
+                    self._lru[user_id] = None
+                else:
+                    self.cache.detach(user_id)
+
+# ====================== LEDGER ======================
+# Каждое изменение баланса/звёзд сразу пишется в журнал ledger (групповой commit
+# раз в несколько мс), а не ждёт автосейва. При старте записи с id > users.ledger_seq
+# переигрываются поверх снимка — деньги не теряются при падении процесса.
+LEDGER_FLUSH_INTERVAL = 0.005  # сек — окно группового commit
+
+class Ledger:
+    def __init__(self, flush_interval: float = LEDGER_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.seq = 0
+        self._pending = []
+        self._flush_task = None
+        self.stats = {"records": 0, "commits": 0, "errors": 0}
+
+    def record(self, user_id: int, field: str, delta: int, reason: str) -> int:
+        """Ставит запись в очередь и возвращает её номер. Синхронно — вызывать рядом с изменением в памяти."""
+        self.seq += 1
+        self._pending.append((self.seq, user_id, field, delta, reason, int(time.time())))
+        self.stats["records"] += 1
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+            except RuntimeError:
+                pass  # нет event loop — запишется при следующем flush()
+        return self.seq
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Ledger: не удалось записать журнал: {e}")
+
+    async def flush(self):
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await backend.append_ledger(rows)
+        except Exception:
+            self.stats["errors"] += 1
+            self._pending[:0] = rows
+            raise
+        self.stats["commits"] += 1
+
+    async def replay(self) -> int:
+        """Применяет к users записи журнала, которых ещё нет в снимке. Возвращает число записей."""
+        replayed, seq = await backend.replay_ledger()
+        self.seq = max(self.seq, seq)
+        return replayed
+
+    async def compact(self):
+        """Удаляет записи, уже попавшие в снимок users."""
+        await backend.compact_ledger()
+
+ledger = Ledger()
+
+def change_balance(user_id: int, user: dict, field: str, delta: int, reason: str) -> int:
+    """Меняет users[...]["balance"/"stars"] на delta и журналирует изменение. Возвращает новое значение."""
+    user[field] = user.get(field, 0) + delta
+    user["ledger_seq"] = ledger.record(user_id, field, delta, reason)
+    return user[field]
+
+# ====================== TICKET MESSAGES ======================
+async def add_ticket_message(t_id: int, sender: str, text: str, date: str):
+    """Одно сообщение тикета — один INSERT; в самом тикете обновляются только счётчики."""
+    await backend.add_ticket_message(t_id, sender, text, date)
+    ticket = tickets.get(t_id)
+    if ticket is not None:
+        ticket["message_count"] = ticket.get("message_count", 0) + 1
+        ticket["last_message_at"] = date
+
+async def create_ticket(t_id: int, ticket: dict, sender: str, text: str, date: str):
+    """Новый тикет: строка тикета, первое сообщение и счётчик id пишутся одной транзакцией.
+
+    Иначе до автосейва в ticket_messages лежала бы переписка тикета, которого нет в tickets.
+    """
+    ticket["message_count"] = 1
+    ticket["last_message_at"] = date
+    await backend.create_ticket(
+        t_id, json_dumps(encode_record("tickets", ticket)), (sender, text, date), {"ticket": counters["ticket"]}
+    )
+    tickets[t_id] = ticket
+
+async def load_ticket_messages(t_id: int) -> list[dict]:
+    rows = await backend.ticket_messages(t_id)
+    return [{"from": sender, "text": text, "date": date} for sender, text, date in rows]
+
+async def migrate_ticket_messages():
+    """Разово выносит старые tickets[t]["messages"] в таблицу ticket_messages."""
+    legacy = [(t_id, t) for t_id, t in tickets.items() if "messages" in t]
+    if not legacy:
+        return
+    for _, t in legacy:
+        msgs = t["messages"]
+        t["message_count"] = len(msgs)
+        t["last_message_at"] = msgs[-1].get("date", "") if msgs else ""
+    # Сообщения и укороченный тикет пишутся одной транзакцией — повторный запуск не задублирует
+    await backend.migrate_ticket_messages([
+        (t_id, [(m.get("from", "user"), m.get("text"), m.get("date", "")) for m in t["messages"]],
+         json_dumps({k: v for k, v in t.items() if k != "messages"}))
+        for t_id, t in legacy
+    ])
+    for _, t in legacy:
+        del t["messages"]
+    logging.info(f"Переписка {len(legacy)} тикетов перенесена в ticket_messages")
+
+# ====================== STORAGE BACKENDS ======================
+# Всё, что autosave() и load_all_data() делают с хранилищем, идёт через backend.
+# Записи приходят уже сериализованными (JSON-строки, строки колонок users),
+# так что бэкенды различаются только стоимостью хранения. InMemoryBackend —
+# для тестов и бенчмарков хендлеров без дискового I/O. Только бэкапы
+# (sqlite3 backup API по DB_PATH) требуют SqliteBackend.
+
+_ARCHIVE_KEYS = {"tickets": "ticket_id", "raffles": "raffle_id"}
+BROADCAST_COLUMNS = ("id", "text", "audience", "status", "cursor", "total", "sent", "failed",
+                     "skipped", "created_by", "created", "finished")
+
+class StorageBackend(ABC):
+    """Интерфейс хранилища. Бэкенд без какого-либо метода не создастся."""
+
+    async def init(self): ...
+    async def close(self): ...
+
+    # Таблицы-словари: (key, data) и таблицы-списки: (id, data)
+    @abstractmethod
+    def iter_dict_rows(self, table: str, key_col: str):
+        """Асинхронный итератор порций [(key, data), ...]."""
+    @abstractmethod
+    async def write_dict(self, table: str, key_col: str, rows: list, deleted: list): ...
+    @abstractmethod
+    def iter_list_rows(self, table: str):
+        """Асинхронный итератор порций [(id, data), ...] по возрастанию id."""
+    @abstractmethod
+    async def list_next_id(self, table: str) -> int | None: ...
+    @abstractmethod
+    async def write_list(self, table: str, rows: list, deleted: list): ...
+
+    @abstractmethod
+    async def load_counters(self, defaults: dict) -> dict: ...
+    @abstractmethod
+    async def save_counters(self, values: dict): ...
+
+    # users: строка — (user_id, *USER_COLUMNS, data)
+    @abstractmethod
+    async def get_user_row(self, user_id: int): ...
+    @abstractmethod
+    async def write_users(self, full_rows: list, partial: dict, deleted: list):
+        """full_rows — строки целиком; partial — {колонки: [(значения..., user_id)]}."""
+    @abstractmethod
+    async def count_users(self) -> int: ...
+    @abstractmethod
+    async def user_rows_page(self, offset: int, limit: int) -> list: ...
+    @abstractmethod
+    async def user_ids_after(self, last_id: int, limit: int) -> list[int]: ...
+    @abstractmethod
+    async def user_reach_after(self, last_id: int, limit: int) -> list[tuple[int, int | None]]:
+        """Как user_ids_after, но пары (user_id, unreachable_at)."""
+    @abstractmethod
+    async def user_reach_of(self, user_ids: list[int]) -> list[tuple[int, int | None]]:
+        """(user_id, unreachable_at) для существующих из user_ids."""
+
+    # Журнал балансов: строка — (id, user_id, field, delta, reason, ts)
+    @abstractmethod
+    async def append_ledger(self, rows: list): ...
+    @abstractmethod
+    async def replay_ledger(self) -> tuple[int, int]:
+        """Применяет журнал к users. Возвращает (переиграно записей, последний id)."""
+    @abstractmethod
+    async def compact_ledger(self): ...
+
+    @abstractmethod
+    async def add_ticket_message(self, t_id: int, sender: str, text: str, date: str): ...
+    @abstractmethod
+    async def ticket_messages(self, t_id: int) -> list[tuple]: ...
+    @abstractmethod
+    async def create_ticket(self, t_id: int, data: str, message: tuple, counters: dict):
+        """Строка тикета, его первое сообщение (sender, text, date) и счётчики — одной транзакцией."""
+    @abstractmethod
+    async def migrate_ticket_messages(self, legacy: list[tuple[int, list[tuple], str]]):
+        """[(ticket_id, [(sender, text, date)], data тикета без messages)] — одной транзакцией."""
+
+    # Архив: тикет — (ticket_id, user_id, closed_at, blob), розыгрыш — (raffle_id, finished_at, blob)
+    @abstractmethod
+    async def archive_records(self, ticket_rows: list, raffle_rows: list):
+        """Пишет записи в архив и удаляет их из tickets/ticket_messages/raffles одной транзакцией."""
+    @abstractmethod
+    async def archived_record(self, table: str, key: int) -> bytes | None: ...
+
+    # Рассылки: задание — кортеж в порядке BROADCAST_COLUMNS,
+    # доставка — (job_id, user_id, status, error, ts)
+    @abstractmethod
+    async def create_broadcast(self, text: str, audience: str, total: int, created_by: int | None,
+                               created: int) -> int: ...
+    @abstractmethod
+    async def get_broadcast(self, job_id: int | None) -> tuple | None:
+        """Задание по id; без id — последнее созданное."""
+    @abstractmethod
+    async def running_broadcast_id(self) -> int | None: ...
+    @abstractmethod
+    async def set_broadcast_status(self, job_id: int, status: str, finished: int | None = None): ...
+    @abstractmethod
+    async def save_broadcast_batch(self, job_id: int, deliveries: list, cursor: int,
+                                   sent: int, failed: int, skipped: int):
+        """Доставки порции и сдвиг курсора — одной транзакцией."""
+
+
+class SqliteBackend(StorageBackend):
+    """DB_PATH через общее WAL-соединение (open_db/db_transaction)."""
+
+    async def init(self):
+        await init_db()
+
+    async def close(self):
+        await close_db()
+
+    async def iter_dict_rows(self, table, key_col):
+        # Своё соединение на таблицу: load_all_data читает их параллельно
+        async with read_connection() as db:
+            async with db.execute(f"SELECT {key_col}, data FROM {table}") as cursor:
+                while rows := await cursor.fetchmany(LOAD_CHUNK_SIZE):
+                    yield rows
+
+    async def write_dict(self, table, key_col, rows, deleted):
+        async with db_transaction() as db:
+            await executemany_chunked(
+                db,
+                f"INSERT INTO {table} ({key_col}, data) VALUES (?, ?) "
+                f"ON CONFLICT({key_col}) DO UPDATE SET data = excluded.data",
+                rows
+            )
+            await executemany_chunked(db, f"DELETE FROM {table} WHERE {key_col} = ?", [(key,) for key in deleted])
+
+    async def iter_list_rows(self, table):
+        async with read_connection() as db:
+            async with db.execute(f"SELECT id, data FROM {table} ORDER BY id") as cursor:
+                while rows := await cursor.fetchmany(LOAD_CHUNK_SIZE):
+                    yield rows
+
+    async def list_next_id(self, table):
+        # AUTOINCREMENT не переиспользует id удалённых строк — и мы не будем
+        db = await open_db()
+        async with db.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)) as cursor:
+            seq = await cursor.fetchone()
+        return seq[0] + 1 if seq else None
+
+    async def write_list(self, table, rows, deleted):
+        async with db_transaction() as db:
+            await executemany_chunked(
+                db,
+                f"INSERT INTO {table} (id, data) VALUES (?, ?) "
+                f"ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                rows
+            )
+            await executemany_chunked(db, f"DELETE FROM {table} WHERE id = ?", [(item_id,) for item_id in deleted])
+
+    async def load_counters(self, defaults):
+        db = await open_db()
+        async with db.execute("SELECT name, value FROM counters") as cursor:
+            stored = dict(await cursor.fetchall())
+        return {name: stored.get(name, default) for name, default in defaults.items()}
+
+    async def save_counters(self, values):
+        async with db_transaction() as db:
+            await db.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                list(values.items())
+            )
+
+    async def get_user_row(self, user_id):
+        db = await open_db()
+        async with db.execute(f"SELECT user_id, {_USER_COLS_SQL}, data FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            return await cursor.fetchone()
+
+    async def write_users(self, full_rows, partial, deleted):
+        async with db_transaction() as db:
+            await executemany_chunked(
+                db,
+                f"INSERT INTO users (user_id, {_USER_COLS_SQL}, data) VALUES (?, {_USER_PLACEHOLDERS}, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                + ", ".join(f"{col} = excluded.{col}" for col in USER_COLUMNS + ("data",)),
+                full_rows
+            )
+            # users[uid]["balance"] -= price → UPDATE users SET balance = ? WHERE user_id = ?
+            for cols, rows in partial.items():
+                assignments = ", ".join(f"{col} = ?" for col in cols)
+                await executemany_chunked(db, f"UPDATE users SET {assignments} WHERE user_id = ?", rows)
+            await executemany_chunked(db, "DELETE FROM users WHERE user_id = ?", [(uid,) for uid in deleted])
+
+    async def count_users(self):
+        db = await open_db()
+        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def user_rows_page(self, offset, limit):
+        db = await open_db()
+        async with db.execute(
+            f"SELECT user_id, {_USER_COLS_SQL}, data FROM users ORDER BY user_id LIMIT ? OFFSET ?", (limit, offset)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def user_ids_after(self, last_id, limit):
+        db = await open_db()
+        async with db.execute(
+            "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_id, limit)
+        ) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def user_reach_after(self, last_id, limit):
+        db = await open_db()
+        async with db.execute(
+            "SELECT user_id, unreachable_at FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_id, limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def user_reach_of(self, user_ids):
+        db = await open_db()
+        rows = []
+        for start in range(0, len(user_ids), SQL_IN_CHUNK):
+            chunk = user_ids[start:start + SQL_IN_CHUNK]
+            async with db.execute(
+                f"SELECT user_id, unreachable_at FROM users WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk
+            ) as cursor:
+                rows.extend(await cursor.fetchall())
+        return rows
+
+    async def append_ledger(self, rows):
+        async with db_transaction() as db:
+            await db.executemany(
+                "INSERT INTO ledger (id, user_id, field, delta, reason, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    async def replay_ledger(self):
+        async with db_transaction() as db:
+            async with db.execute(
+                "SELECT COUNT(*) FROM ledger l WHERE l.id > "
+                "COALESCE((SELECT ledger_seq FROM users u WHERE u.user_id = l.user_id), 0)"
+            ) as cursor:
+                replayed = (await cursor.fetchone())[0]
+            if replayed:
+                # Профиля нет только у записанного до create() — создаём полный, а не пустую строку
+                await db.execute(
+                    "INSERT OR IGNORE INTO users (user_id, created, data) SELECT DISTINCT user_id, ?, ? FROM ledger",
+                    (int(time.time()), json_dumps(USER_DATA_DEFAULTS))
+                )
+                await db.execute('''
+                    UPDATE users SET
+                        balance = balance + COALESCE((SELECT SUM(delta) FROM ledger l
+                            WHERE l.user_id = users.user_id AND l.field = 'balance' AND l.id > users.ledger_seq), 0),
+                        stars = stars + COALESCE((SELECT SUM(delta) FROM ledger l
+                            WHERE l.user_id = users.user_id AND l.field = 'stars' AND l.id > users.ledger_seq), 0),
+                        ledger_seq = (SELECT MAX(id) FROM ledger l WHERE l.user_id = users.user_id)
+                    WHERE EXISTS (SELECT 1 FROM ledger l WHERE l.user_id = users.user_id AND l.id > users.ledger_seq)
+                ''')
+            await self._compact(db)
+            async with db.execute(
+                "SELECT MAX(COALESCE((SELECT MAX(id) FROM ledger), 0), COALESCE((SELECT MAX(ledger_seq) FROM users), 0))"
+            ) as cursor:
+                seq = (await cursor.fetchone())[0]
+        return replayed, seq
+
+    async def compact_ledger(self):
+        async with db_transaction() as db:
+            await self._compact(db)
+
+    @staticmethod
+    async def _compact(db):
         await db.execute(
-            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
-            (name, value)
+            "DELETE FROM ledger WHERE id <= "
+            "COALESCE((SELECT ledger_seq FROM users u WHERE u.user_id = ledger.user_id), 0)"
         )
-        await db.commit()
 
-async def load_counter(name: str, default: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT value FROM counters WHERE name = ?", (name,)) as cursor:
+    async def add_ticket_message(self, t_id, sender, text, date):
+        async with db_transaction() as db:
+            await db.execute(
+                "INSERT INTO ticket_messages (ticket_id, sender, text, date) VALUES (?, ?, ?, ?)",
+                (t_id, sender, text, date)
+            )
+
+    async def create_ticket(self, t_id, data, message, counters):
+        async with db_transaction() as db:
+            await db.execute(
+                "INSERT INTO tickets (ticket_id, data) VALUES (?, ?) "
+                "ON CONFLICT(ticket_id) DO UPDATE SET data = excluded.data",
+                (t_id, data)
+            )
+            await db.execute(
+                "INSERT INTO ticket_messages (ticket_id, sender, text, date) VALUES (?, ?, ?, ?)", (t_id, *message)
+            )
+            await db.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                list(counters.items())
+            )
+
+    async def ticket_messages(self, t_id):
+        db = await open_db()
+        async with db.execute(
+            "SELECT sender, text, date FROM ticket_messages WHERE ticket_id = ? ORDER BY id", (t_id,)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def migrate_ticket_messages(self, legacy):
+        async with db_transaction() as db:
+            for t_id, messages, meta in legacy:
+                await db.executemany(
+                    "INSERT INTO ticket_messages (ticket_id, sender, text, date) VALUES (?, ?, ?, ?)",
+                    [(t_id, *message) for message in messages]
+                )
+                await db.execute("UPDATE tickets SET data = ? WHERE ticket_id = ?", (meta, t_id))
+
+    async def archive_records(self, ticket_rows, raffle_rows):
+        old_tickets = [(row[0],) for row in ticket_rows]
+        async with db_transaction() as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO tickets_archive (ticket_id, user_id, closed_at, data) VALUES (?, ?, ?, ?)",
+                ticket_rows
+            )
+            await db.executemany("DELETE FROM ticket_messages WHERE ticket_id = ?", old_tickets)
+            await db.executemany("DELETE FROM tickets WHERE ticket_id = ?", old_tickets)
+            await db.executemany(
+                "INSERT OR REPLACE INTO raffles_archive (raffle_id, finished_at, data) VALUES (?, ?, ?)",
+                raffle_rows
+            )
+            await db.executemany("DELETE FROM raffles WHERE raffle_id = ?", [(row[0],) for row in raffle_rows])
+
+    async def archived_record(self, table, key):
+        db = await open_db()
+        async with db.execute(f"SELECT data FROM {table}_archive WHERE {_ARCHIVE_KEYS[table]} = ?", (key,)) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def create_broadcast(self, text, audience, total, created_by, created):
+        async with db_transaction() as db:
+            cursor = await db.execute(
+                "INSERT INTO broadcast_jobs (text, audience, total, created_by, created) VALUES (?, ?, ?, ?, ?)",
+                (text, audience, total, created_by, created)
+            )
+            return cursor.lastrowid
+
+    async def get_broadcast(self, job_id):
+        db = await open_db()
+        sql = f"SELECT {', '.join(BROADCAST_COLUMNS)} FROM broadcast_jobs "
+        sql += "WHERE id = ?" if job_id is not None else "ORDER BY id DESC LIMIT 1"
+        async with db.execute(sql, (job_id,) if job_id is not None else ()) as cursor:
+            return await cursor.fetchone()
+
+    async def running_broadcast_id(self):
+        db = await open_db()
+        async with db.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id LIMIT 1") as cursor:
             row = await cursor.fetchone()
-            return row[0] if row else default
+        return row[0] if row else None
+
+    async def set_broadcast_status(self, job_id, status, finished=None):
+        async with db_transaction() as db:
+            await db.execute(
+                "UPDATE broadcast_jobs SET status = ?, finished = COALESCE(?, finished) WHERE id = ?",
+                (status, finished, job_id)
+            )
+
+    async def save_broadcast_batch(self, job_id, deliveries, cursor, sent, failed, skipped):
+        async with db_transaction() as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO broadcast_deliveries (job_id, user_id, status, error, ts) VALUES (?, ?, ?, ?, ?)",
+                deliveries
+            )
+            await db.execute(
+                "UPDATE broadcast_jobs SET cursor = ?, sent = sent + ?, failed = failed + ?, skipped = skipped + ? "
+                "WHERE id = ?",
+                (cursor, sent, failed, skipped, job_id)
+            )
+
+
+class InMemoryBackend(StorageBackend):
+    """Те же операции над словарями в памяти; данные живут, пока жив объект."""
+
+    _USER_INDEX = {col: i + 1 for i, col in enumerate(USER_COLUMNS + ("data",))}
+
+    def __init__(self):
+        self.tables = {}       # table -> {key: data}
+        self.sequences = {}    # table -> последний выданный id
+        self.counters = {}
+        self.users = {}        # user_id -> [user_id, *USER_COLUMNS, data]
+        self.ledger = []
+        self.messages = {}     # ticket_id -> [(sender, text, date)]
+        self.archive = {}      # "tickets"/"raffles" -> {key: (..., blob)}
+        self.broadcasts = {}   # job_id -> {колонка: значение}
+        self.deliveries = {}   # (job_id, user_id) -> (status, error, ts)
+
+    @staticmethod
+    def _chunks(rows):
+        for start in range(0, len(rows), LOAD_CHUNK_SIZE):
+            yield rows[start:start + LOAD_CHUNK_SIZE]
+
+    async def iter_dict_rows(self, table, key_col):
+        for chunk in self._chunks(list(self.tables.get(table, {}).items())):
+            yield chunk
+
+    async def write_dict(self, table, key_col, rows, deleted):
+        data = self.tables.setdefault(table, {})
+        data.update(rows)
+        for key in deleted:
+            data.pop(key, None)
+
+    async def iter_list_rows(self, table):
+        for chunk in self._chunks(sorted(self.tables.get(table, {}).items())):
+            yield chunk
+
+    async def list_next_id(self, table):
+        seq = self.sequences.get(table)
+        return seq + 1 if seq is not None else None
+
+    async def write_list(self, table, rows, deleted):
+        await self.write_dict(table, "id", rows, deleted)
+        if rows:
+            self.sequences[table] = max(self.sequences.get(table, 0), max(item_id for item_id, _ in rows))
+
+    async def load_counters(self, defaults):
+        return {name: self.counters.get(name, default) for name, default in defaults.items()}
+
+    async def save_counters(self, values):
+        self.counters.update(values)
+
+    async def get_user_row(self, user_id):
+        row = self.users.get(user_id)
+        return tuple(row) if row is not None else None
+
+    async def write_users(self, full_rows, partial, deleted):
+        for row in full_rows:
+            self.users[row[0]] = list(row)
+        for cols, rows in partial.items():
+            index = [self._USER_INDEX[col] for col in cols]
+            for values in rows:
+                row = self.users.get(values[-1])
+                if row is not None:
+                    for i, value in zip(index, values):
+                        row[i] = value
+        for uid in deleted:
+            self.users.pop(uid, None)
+
+    async def count_users(self):
+        return len(self.users)
+
+    async def user_rows_page(self, offset, limit):
+        return [tuple(self.users[uid]) for uid in sorted(self.users)[offset:offset + limit]]
+
+    async def user_ids_after(self, last_id, limit):
+        return [uid for uid in sorted(self.users) if uid > last_id][:limit]
+
+    async def user_reach_after(self, last_id, limit):
+        reach_i = self._USER_INDEX["unreachable_at"]
+        return [(uid, self.users[uid][reach_i]) for uid in await self.user_ids_after(last_id, limit)]
+
+    async def user_reach_of(self, user_ids):
+        reach_i = self._USER_INDEX["unreachable_at"]
+        return [(uid, self.users[uid][reach_i]) for uid in dict.fromkeys(user_ids) if uid in self.users]
+
+    async def append_ledger(self, rows):
+        self.ledger.extend(rows)
+
+    async def replay_ledger(self):
+        seq_i = self._USER_INDEX["ledger_seq"]
+        replayed = 0
+        for entry_id, uid, field, delta, _, _ in self.ledger:
+            row = self.users.setdefault(
+                uid, [uid, 0, 0, "", "", 0, int(time.time()), None, 0, None, json_dumps(USER_DATA_DEFAULTS)]
+            )
+            if entry_id > row[seq_i]:
+                row[self._USER_INDEX[field]] += delta
+                row[seq_i] = entry_id
+                replayed += 1
+        await self.compact_ledger()
+        seq = max([row[seq_i] for row in self.users.values()] + [row[0] for row in self.ledger] + [0])
+        return replayed, seq
+
+    async def compact_ledger(self):
+        seq_i = self._USER_INDEX["ledger_seq"]
+        self.ledger = [
+            entry for entry in self.ledger
+            if entry[0] > (self.users[entry[1]][seq_i] if entry[1] in self.users else 0)
+        ]
+
+    async def add_ticket_message(self, t_id, sender, text, date):
+        self.messages.setdefault(t_id, []).append((sender, text, date))
+
+    async def ticket_messages(self, t_id):
+        return list(self.messages.get(t_id, ()))
+
+    async def create_ticket(self, t_id, data, message, counters):
+        self.tables.setdefault("tickets", {})[t_id] = data
+        self.messages.setdefault(t_id, []).append(tuple(message))
+        self.counters.update(counters)
+
+    async def migrate_ticket_messages(self, legacy):
+        tickets_table = self.tables.setdefault("tickets", {})
+        for t_id, messages, meta in legacy:
+            self.messages.setdefault(t_id, []).extend(messages)
+            if t_id in tickets_table:
+                tickets_table[t_id] = meta
+
+    async def archive_records(self, ticket_rows, raffle_rows):
+        for t_id, *row in ticket_rows:
+            self.archive.setdefault("tickets", {})[t_id] = tuple(row)
+            self.messages.pop(t_id, None)
+            self.tables.get("tickets", {}).pop(t_id, None)
+        for r_id, *row in raffle_rows:
+            self.archive.setdefault("raffles", {})[r_id] = tuple(row)
+            self.tables.get("raffles", {}).pop(r_id, None)
+
+    async def archived_record(self, table, key):
+        row = self.archive.get(table, {}).get(key)
+        return row[-1] if row else None
+
+    async def create_broadcast(self, text, audience, total, created_by, created):
+        job_id = self.sequences.get("broadcast_jobs", 0) + 1
+        self.sequences["broadcast_jobs"] = job_id
+        self.broadcasts[job_id] = {
+            "id": job_id, "text": text, "audience": audience, "status": "running", "cursor": 0, "total": total,
+            "sent": 0, "failed": 0, "skipped": 0, "created_by": created_by, "created": created, "finished": None,
+        }
+        return job_id
+
+    async def get_broadcast(self, job_id):
+        if job_id is None:
+            job_id = max(self.broadcasts, default=None)
+        job = self.broadcasts.get(job_id)
+        return tuple(job[col] for col in BROADCAST_COLUMNS) if job else None
+
+    async def running_broadcast_id(self):
+        return min((job_id for job_id, job in self.broadcasts.items() if job["status"] == "running"), default=None)
+
+    async def set_broadcast_status(self, job_id, status, finished=None):
+        job = self.broadcasts.get(job_id)
+        if job is not None:
+            job["status"] = status
+            if finished is not None:
+                job["finished"] = finished
+
+    async def save_broadcast_batch(self, job_id, deliveries, cursor, sent, failed, skipped):
+        for row in deliveries:
+            self.deliveries[row[0], row[1]] = row[2:]
+        job = self.broadcasts.get(job_id)
+        if job is not None:
+            job["cursor"] = cursor
+            job["sent"] += sent
+            job["failed"] += failed
+            job["skipped"] += skipped
+
+
+backend: StorageBackend = SqliteBackend()
+
+def use_backend(new_backend: StorageBackend) -> StorageBackend:
+    """Переключает хранилище (например, на InMemoryBackend в бенчмарках)."""
+    global backend
+    backend = new_backend
+    return new_backend
+
+# ====================== ARCHIVE ======================
+# В памяти живут только открытые тикеты и идущие розыгрыши. Закрытые и
+# завершённые старше ARCHIVE_AFTER_DAYS переезжают в *_archive и читаются
+# оттуда по запросу.
+ARCHIVE_AFTER_DAYS = 30
+archive_stats = {"runs": 0, "tickets": 0, "raffles": 0}
+
+def _pack_archived(table: str, record: dict) -> bytes:
+    return zlib.compress(json_dumps(encode_record(table, record)).encode("utf-8"))
+
+def _unpack_archived(table: str, blob: bytes) -> dict:
+    return decode_record(table, json_loads(zlib.decompress(blob)))
+
+async def archive_old_records(days: int | None = None) -> tuple[int, int]:
+    """Переносит старые закрытые тикеты и завершённые розыгрыши в архив."""
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS if days is None else days)
+    now = datetime.now()
+
+    old_tickets = []
+    for t_id, t in tickets.items():
+        if t.get("open", True):
+            continue
+        if t.get("closed_at") is None:
+            # Закрыт до появления closed_at — отсчитываем срок с этого момента
+            t["closed_at"] = now
+        if t["closed_at"] <= cutoff:
+            old_tickets.append(t_id)
+
+    old_raffles = [
+        r_id for r_id, r in raffles.items()
+        if r.get("finished") and (r.get("finished_at") or r.get("ends_at") or now) <= cutoff
+    ]
+    if not old_tickets and not old_raffles:
+        return 0, 0
+
+    # Сначала убираем записи из отслеживаемых словарей (до первого await): автосейв
+    # больше их не увидит, а flush, успевший их забрать, уже стоит в очереди на
+    # _db_write_lock раньше нас — его запись не переживёт наш DELETE.
+    ticket_records = {t_id: tickets[t_id] for t_id in old_tickets}
+    raffle_records = {r_id: raffles[r_id] for r_id in old_raffles}
+    for t_id in old_tickets:
+        tickets.discard(t_id)
+    for r_id in old_raffles:
+        raffles.discard(r_id)
+    try:
+        await _archive_rows(ticket_records, raffle_records)
+    except Exception:
+        # Не получилось — возвращаем записи, автосейв сохранит их как обычно
+        tickets.update(ticket_records)
+        raffles.update(raffle_records)
+        raise
+
+    archive_stats["runs"] += 1
+    archive_stats["tickets"] += len(old_tickets)
+    archive_stats["raffles"] += len(old_raffles)
+    logging.info(f"Архив: перенесено тикетов {len(old_tickets)}, розыгрышей {len(old_raffles)}")
+    return len(old_tickets), len(old_raffles)
+
+async def _archive_rows(ticket_records: dict, raffle_records: dict):
+    ticket_rows = []
+    for t_id, t in ticket_records.items():
+        record = dict(t)
+        record["messages"] = await load_ticket_messages(t_id)
+        ticket_rows.append((t_id, record.get("user_id"), int(record["closed_at"].timestamp()),
+                            _pack_archived("tickets", record)))
+    raffle_rows = []
+    for r_id, r in raffle_records.items():
+        record = dict(r)
+        finished_at = record.get("finished_at") or record.get("ends_at")
+        raffle_rows.append((r_id, int(finished_at.timestamp()) if finished_at else None,
+                            _pack_archived("raffles", record)))
+    await backend.archive_records(ticket_rows, raffle_rows)
+
+async def load_archived_ticket(t_id: int) -> dict | None:
+    blob = await backend.archived_record("tickets", t_id)
+    return _unpack_archived("tickets", blob) if blob is not None else None
+
+async def load_archived_raffle(r_id: int) -> dict | None:
+    blob = await backend.archived_record("raffles", r_id)
+    return _unpack_archived("raffles", blob) if blob is not None else None
 
 pending_requests = {}
 
@@ -200,18 +1909,18 @@ ADMIN_IDS = [6081780420]  # ← СВОИ АДМИН-ID (уровень 3 по у
 admins = {6081780420: 3}  # Начальный админ уровня 3
 
 # ====================== DATA (будет загружаться из БД) ======================
-users = {}
-products = {}
-tickets = {}
-raffles = {}
-reviews = []
-channels_required = []
-banned_users = {}
-group_data = {}
-autopost_channels = []
-pending_autoposts = {}
-counters = {"product": 1, "ticket": 1, "raffle": 1, "autopost": 1}
-admins = {}
+users = UserRepository()
+products = TrackedDict()
+tickets = TrackedDict()
+raffles = TrackedDict()
+reviews = TrackedList()
+channels_required = TrackedList()
+banned_users = TrackedDict()
+group_data = TrackedDict()
+autopost_channels = TrackedList()
+pending_autoposts = TrackedDict()
+counters = {"product": 1, "ticket": 1, "raffle": 1, "autopost": 1, "reminder_cursor": 0, "reminder_done": 0}
+admins = TrackedDict()
 
 # ====================== STATES ======================
 class UserStates(StatesGroup):
@@ -341,16 +2050,192 @@ def admin_panel_kb(level: int):
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
 # ====================== HELPERS ======================
+class LatencyStats:
+    """Задержки последних window вызовов: перцентили, таймауты, ошибки."""
+
+    def __init__(self, window: int = 1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self) -> str:
+        return (f"p50 {self.percentile(0.5) * 1000:.0f} мс, p90 {self.percentile(0.9) * 1000:.0f} мс, "
+                f"p99 {self.percentile(0.99) * 1000:.0f} мс, вызовов {self.count}, "
+                f"таймаутов {self.timeouts}, ошибок {self.errors}")
+
+
+class TokenBucket:
+    """Не больше rate операций в секунду, всплеск — до capacity."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1):
+        self._refill()
+        while self.tokens < tokens:
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= tokens
+
+    def ready(self, tokens: float = 1) -> bool:
+        self._refill()
+        return self.tokens >= tokens
+
+# Кэш подписок: (user_id, channel_id) -> (подписан, когда истекает по time.monotonic()).
+# «Не подписан» тоже кэшируется, но короче — после подписки жмут check_sub,
+# и он сбрасывает кэш пользователя.
+SUB_CACHE_TTL = 300           # сек — сколько верим подтверждённой подписке
+SUB_CACHE_NEGATIVE_TTL = 30   # сек — сколько верим «left/kicked»
+SUB_CACHE_MAX = 100_000       # больше записей — выкидываем самые давние
+
+_sub_cache: OrderedDict = OrderedDict()   # в порядке записи: самые давние — в начале
+sub_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def _sub_cache_get(user_id: int, channel_id: int):
+    entry = _sub_cache.get((user_id, channel_id))
+    if entry is None or entry[1] <= time.monotonic():
+        sub_cache_stats["misses"] += 1
+        return None
+    sub_cache_stats["hits"] += 1
+    return entry[0]
+
+def _sub_cache_put(user_id: int, channel_id: int, is_member: bool):
+    now = time.monotonic()
+    key = (user_id, channel_id)
+    _sub_cache[key] = (is_member, now + (SUB_CACHE_TTL if is_member else SUB_CACHE_NEGATIVE_TTL))
+    _sub_cache.move_to_end(key)
+    # С начала уходят просроченные и, если кэш полон, самые давние — O(1) на запись
+    while _sub_cache:
+        expires = next(iter(_sub_cache.values()))[1]
+        if expires > now and len(_sub_cache) <= SUB_CACHE_MAX:
+            break
+        _sub_cache.popitem(last=False)
+
+def invalidate_subscription(user_id: int, channel_id: int | None = None):
+    """Сбрасывает кэш подписок пользователя (по всем каналам или по одному)."""
+    channels = [channel_id] if channel_id is not None else [ch["channel_id"] for ch in channels_required]
+    for ch_id in channels:
+        if _sub_cache.pop((user_id, ch_id), None) is not None:
+            sub_cache_stats["invalidations"] += 1
+        membership_index.get(ch_id, set()).discard(user_id)
+        membership_left.get(ch_id, set()).discard(user_id)
+
+# Индекс подписчиков из апдейтов chat_member: channel_id -> user_id подписчиков
+# и тех, кто точно вышел. Апдейты приходят, только если бот админ канала, поэтому
+# ответы API кладём в индекс лишь для каналов, от которых апдейты уже были
+# (membership_live) — иначе индекс молча устареет. Остальное — через TTL-кэш.
+membership_index: dict[int, set[int]] = {}
+membership_left: dict[int, set[int]] = {}
+membership_live: set[int] = set()
+membership_stats = {"events": 0, "index_hits": 0, "api_fallbacks": 0}
+
+def _is_member_status(member) -> bool:
+    if member.status == "restricted":
+        return bool(getattr(member, "is_member", True))
+    return member.status not in ("left", "kicked")
+
+def record_membership(channel_id: int, user_id: int, is_member: bool):
+    members = membership_index.setdefault(channel_id, set())
+    left = membership_left.setdefault(channel_id, set())
+    if is_member:
+        members.add(user_id)
+        left.discard(user_id)
+    else:
+        members.discard(user_id)
+        left.add(user_id)
+
+def forget_channel_membership(channel_id: int):
+    membership_index.pop(channel_id, None)
+    membership_left.pop(channel_id, None)
+    membership_live.discard(channel_id)
+
+def known_membership(channel_id: int, user_id: int) -> bool | None:
+    """Подписан ли пользователь по данным индекса; None — индекс не знает."""
+    if user_id in membership_index.get(channel_id, ()):
+        return True
+    if user_id in membership_left.get(channel_id, ()):
+        return False
+    return None
+
+# Проверка каналов, которых нет ни в индексе, ни в кэше, идёт параллельно,
+# каждый запрос — не дольше SUB_CHECK_TIMEOUT.
+SUB_CHECK_TIMEOUT = 3.0     # сек на один get_chat_member
+SUB_ERROR_POLICY = "deny"   # ошибка/таймаут API: "deny" — считать неподписанным, "allow" — пропустить канал
+channel_latency: dict[int, LatencyStats] = {}
+
+async def _check_channel(bot: Bot, channel_id: int, user_id: int) -> bool | None:
+    """Подписка по API; None — ошибка или таймаут (такой ответ не кэшируется)."""
+    stats = channel_latency.setdefault(channel_id, LatencyStats())
+    membership_stats["api_fallbacks"] += 1
+    started = time.perf_counter()
+    try:
+        member: ChatMember = await asyncio.wait_for(bot.get_chat_member(channel_id, user_id), SUB_CHECK_TIMEOUT)
+    except asyncio.TimeoutError:
+        stats.timeouts += 1
+        logging.warning(f"get_chat_member({channel_id}) не ответил за {SUB_CHECK_TIMEOUT} с")
+        return None
+    except Exception as e:
+        stats.errors += 1
+        logging.warning(f"get_chat_member({channel_id}, {user_id}): {e}")
+        return None
+    stats.add(time.perf_counter() - started)
+    is_member = _is_member_status(member)
+    _sub_cache_put(user_id, channel_id, is_member)
+    if channel_id in membership_live:
+        record_membership(channel_id, user_id, is_member)
+    return is_member
+
 async def is_subscribed(bot: Bot, user_id: int) -> bool:
     if not channels_required:
         return True
+    unknown = []
     for ch in channels_required:
-        try:
-            member: ChatMember = await bot.get_chat_member(ch["channel_id"], user_id)
-            if member.status in ("left", "kicked"):
-                return False
-        except:
+        ch_id = ch["channel_id"]
+        known = known_membership(ch_id, user_id)
+        if known is not None:
+            membership_stats["index_hits"] += 1
+        else:
+            known = _sub_cache_get(user_id, ch_id)
+        if known is False:
             return False
+        if known is None:
+            unknown.append(ch_id)
+    if not unknown:
+        return True
+    if len(unknown) == 1:
+        result = await _check_channel(bot, unknown[0], user_id)
+        return result if result is not None else SUB_ERROR_POLICY == "allow"
+    tasks = [asyncio.create_task(_check_channel(bot, ch_id, user_id)) for ch_id in unknown]
+    try:
+        # Первый же «left/kicked» решает дело — остальные запросы отменяем
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            if result is None:
+                result = SUB_ERROR_POLICY == "allow"
+            if not result:
+                return False
+    finally:
+        for task in tasks:
+            task.cancel()
     return True
 
 def subscription_text():
@@ -362,16 +2247,6 @@ def subscription_text():
     text += "\nПосле подписки нажми «Проверить»"
     return text
 
-async def check_subscription_and_prompt(message: Message, is_group=False):
-    if not await is_subscribed(bot, message.from_user.id):
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_sub")]])
-        if is_group:
-            await message.reply(subscription_text(), reply_markup=kb)
-        else:
-            await message.answer(subscription_text(), reply_markup=kb)
-        return False
-    return True
-
 async def is_banned(user_id: int) -> bool:
     ban = banned_users.get(user_id)
     if ban:
@@ -398,78 +2273,196 @@ def is_spam_message(text: str) -> bool:
 
 # ====================== BOT SETUP ======================
 
-# ====================== EMOJI WRAPPER (AUTOMATIC) ======================
-# Добавлено автоматически: каждое текстовое сообщение бота будет получать небольшой эмодзи в конце.
-# Это НЕ меняет логику бота — только визуально украшает тексты.
+bot = Bot(
+    token=API_TOKEN,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
+
+# ====================== OUTBOUND REQUEST MIDDLEWARES ======================
+# Всё, что бот отправляет в Telegram (bot.send_*, message.answer/reply/edit_text,
+# outbox), проходит через цепочку bot.session: украшение текста, ошибки,
+# общий лимит на отправку сообщений, замер времени запроса.
 _EMOJI = " ✨"
+# Какое поле метода украшать эмодзи в конце
+DECORATED_FIELDS = {
+    SendMessage: "text",
+    EditMessageText: "text",
+    SendPhoto: "caption",
+    SendVideo: "caption",
+    SendDocument: "caption",
+    SendAudio: "caption",
+}
+API_SEND_RATE = 30            # сообщений в секунду на весь бот (лимит Telegram)
+API_SEND_PREFIXES = ("send", "forward", "copy", "edit")
+
+# Полосы приоритета исходящих: ответы пользователю, уведомления админам, массовые
+# рассылки. Полоса берётся из send_lane (по умолчанию — interactive); фоновые
+# задачи выставляют её через in_lane(). LANE_SHARE — потолок доли общего лимита,
+# пока более приоритетные полосы активны (ждут токена или слали за последние
+# LANE_ACTIVE_WINDOW сек); одна рассылка без конкурентов идёт на полной скорости.
+# LANE_WEIGHT — вес полосы при выборе следующего сообщения в outbox.
+LANES = ("interactive", "admin", "bulk")
+LANE_SHARE = {"interactive": 1.0, "admin": 0.9, "bulk": 0.8}
+LANE_WEIGHT = {"interactive": 8, "admin": 4, "bulk": 1}
+LANE_ACTIVE_WINDOW = 1.0
+
+send_lane: ContextVar[str] = ContextVar("send_lane", default="interactive")
+_send_paced: ContextVar[bool] = ContextVar("_send_paced", default=False)   # токен уже взял outbox
+
+@contextmanager
+def in_lane(lane: str):
+    token = send_lane.set(lane)
+    try:
+        yield
+    finally:
+        send_lane.reset(token)
 
-def _make_wrapper(func):
-    async def _wrapped(*args, **kwargs):
-        # Append emoji to common text-like kwargs
-        for key in ("text", "caption"):
-            if key in kwargs and isinstance(kwargs[key], str):
-                kwargs[key] = kwargs[key] + _EMOJI
-        # If positional args contain a string (after self/chat_id), append emoji to the first found
-        args_list = list(args)
-        for i in range(0, len(args_list)):
-            # skip 'self' references that are objects (not plain str)
-            if isinstance(args_list[i], str):
-                # avoid changing token in Bot(token=...) style - but here positional strings are message texts
-                args_list[i] = args_list[i] + _EMOJI
-                args = tuple(args_list)
-                break
-        return await func(*args, **kwargs)
-    return _wrapped
+request_latency: dict[str, LatencyStats] = {}
+request_errors: dict[str, int] = {}
 
-# Apply wrappers to common sending/editing methods if available in the aiogram classes.
-try:
-    from aiogram import Bot
-    # Patch Bot methods
-    if hasattr(Bot, "send_message"):
-        Bot.send_message = _make_wrapper(Bot.send_message)
-    if hasattr(Bot, "send_photo"):
-        Bot.send_photo = _make_wrapper(Bot.send_photo)
-    if hasattr(Bot, "send_document"):
-        Bot.send_document = _make_wrapper(Bot.send_document)
-    if hasattr(Bot, "send_video"):
-        Bot.send_video = _make_wrapper(Bot.send_video)
-    if hasattr(Bot, "send_audio"):
-        Bot.send_audio = _make_wrapper(Bot.send_audio)
-except Exception:
-    # If aiogram isn't importable at patch time, we'll patch later (after bot import) below.
-    pass
 
-# We'll also try to patch Message methods (for message.answer, message.reply, message.edit_text)
-try:
-    from aiogram.types import Message as AiogramMessage
-    if hasattr(AiogramMessage, "answer"):
-        AiogramMessage.answer = _make_wrapper(AiogramMessage.answer)
-    if hasattr(AiogramMessage, "reply"):
-        AiogramMessage.reply = _make_wrapper(AiogramMessage.reply)
-    if hasattr(AiogramMessage, "edit_text"):
-        AiogramMessage.edit_text = _make_wrapper(AiogramMessage.edit_text)
-except Exception:
-    pass
+class DecorateRequestMiddleware(BaseRequestMiddleware):
+    """Дописывает _EMOJI к тексту/подписи исходящего сообщения — один раз на запрос."""
 
-# If bot already created earlier in file, patch its instance methods too (safe no-op if names missing)
-def _patch_instance_methods(bot_instance):
-    try:
-        if hasattr(bot_instance, "send_message"):
-            bot_instance.send_message = _make_wrapper(bot_instance.send_message)
-        if hasattr(bot_instance, "send_photo"):
-            bot_instance.send_photo = _make_wrapper(bot_instance.send_photo)
-        if hasattr(bot_instance, "send_document"):
-            bot_instance.send_document = _make_wrapper(bot_instance.send_document)
-        if hasattr(bot_instance, "send_video"):
-            bot_instance.send_video = _make_wrapper(bot_instance.send_video)
-    except Exception:
-        pass
+    async def __call__(self, make_request, bot, method):
+        field = DECORATED_FIELDS.get(type(method))
+        if field is not None:
+            value = getattr(method, field, None)
+            if isinstance(value, str):
+                method = method.model_copy(update={field: value + _EMOJI})
+        return await make_request(bot, method)
+
+
+class ErrorClassifyMiddleware(BaseRequestMiddleware):
+    """Считает ошибки API по видам; на retry_after ставит на паузу весь лимитер,
+    на Forbidden / «chat not found» в личке помечает пользователя недоступным."""
+
+    async def __call__(self, make_request, bot, method):
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self._count("retry_after")
+            api_limiter.pause(e.retry_after)
+            raise
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            if is_unreachable_error(e):
+                self._count("unreachable")
+                chat_id = getattr(method, "chat_id", None)
+                if isinstance(chat_id, int) and chat_id > 0:
+                    await mark_unreachable(chat_id)
+            else:
+                self._count("bad_request")
+            raise
+        except TelegramNetworkError:
+            self._count("network")
+            raise
+        except TelegramServerError:
+            self._count("server")
+            raise
+        except TelegramAPIError:
+            self._count("other")
+            raise
+
+    @staticmethod
+    def _count(kind: str):
+        request_errors[kind] = request_errors.get(kind, 0) + 1
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Общий TokenBucket на методы, отправляющие сообщения; остальные не ждут.
+
+    Пока токена ждёт более приоритетная полоса, младшие его не получают;
+    admin и bulk вдобавок не выходят за свою долю LANE_SHARE, пока старшие активны.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.bucket = TokenBucket(rate)
+        self.lane_buckets = {lane: TokenBucket(rate * share) for lane, share in LANE_SHARE.items() if share < 1}
+        self.waiting = dict.fromkeys(LANES, 0)
+        self.last_taken = dict.fromkeys(LANES, float("-inf"))
+        self.wait_latency = {lane: LatencyStats() for lane in LANES}
+        self.paused_until = 0.0
+        self.waited = 0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _capped(self, lane: str) -> bool:
+        """Действует ли на полосу её LANE_SHARE: только пока старшие полосы активны."""
+        if lane not in self.lane_buckets:
+            return False
+        now = time.monotonic()
+        return any(self.waiting[higher] or now - self.last_taken[higher] < LANE_ACTIVE_WINDOW
+                   for higher in LANES[:LANES.index(lane)])
+
+    def can_take(self, lane: str) -> bool:
+        """Можно ли полосе взять токен прямо сейчас (без ожидания)."""
+        if self.paused_until > time.monotonic():
+            return False
+        if any(self.waiting[higher] for higher in LANES[:LANES.index(lane)]):
+            return False
+        return self.bucket.ready() and (not self._capped(lane) or self.lane_buckets[lane].ready())
+
+    def take(self, lane: str, waited: float = 0.0):
+        """Списывает токен полосы; вызывать сразу после can_take, без await между ними."""
+        if self._capped(lane):
+            self.lane_buckets[lane].tokens -= 1
+        self.bucket.tokens -= 1
+        self.last_taken[lane] = time.monotonic()
+        self.wait_latency[lane].add(waited)
+
+    async def wait_turn(self, lane: str):
+        """Одна пауза в очереди за токеном: полоса числится ждущей, младшие ей уступают."""
+        self.waiting[lane] += 1
+        try:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                self.waited += 1
+            await asyncio.sleep(max(delay, 1 / self.rate))
+        finally:
+            self.waiting[lane] -= 1
+
+    async def acquire(self, lane: str):
+        started = time.monotonic()
+        while not self.can_take(lane):
+            await self.wait_turn(lane)
+        self.take(lane, time.monotonic() - started)
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__.startswith(API_SEND_PREFIXES) and not _send_paced.get():
+            await self.acquire(send_lane.get())
+        return await make_request(bot, method)
+
+
+class TimingMiddleware(BaseRequestMiddleware):
+    """Время самого HTTP-запроса по методам API — для /metrics."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        stats = request_latency.get(name)
+        if stats is None:
+            stats = request_latency[name] = LatencyStats()
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramNetworkError:
+            stats.timeouts += 1
+            raise
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.add(time.perf_counter() - started)
+
+
+api_limiter = RateLimitMiddleware(API_SEND_RATE)
+# Первый зарегистрированный — внешний: ошибки видны и после ожидания лимита
+bot.session.middleware(DecorateRequestMiddleware())
+bot.session.middleware(ErrorClassifyMiddleware())
+bot.session.middleware(api_limiter)
+bot.session.middleware(TimingMiddleware())
 
-# ====================== END EMOJI WRAPPER ======================
-bot = Bot(
-    token=API_TOKEN,
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
@@ -477,65 +2470,483 @@ dp.include_router(router)
 
 scheduler = AsyncIOScheduler()
 
+# Метрика автосейва: сколько строк записано/удалено за последний цикл и всего
+autosave_stats = {"cycles": 0, "last_rows": 0, "last_deleted": 0, "total_rows": 0, "total_deleted": 0}
+
 async def autosave():
-    await save_dict("users", users)
-    await save_dict("products", products, "product_id")
-    await save_dict("tickets", tickets, "ticket_id")
-    await save_dict("raffles", raffles, "raffle_id")
-    await save_list("reviews", reviews)
-    await save_list("channels_required", channels_required)
-    await save_dict("banned_users", banned_users)
-    await save_dict("group_data", group_data, "chat_id")
-    await save_list("autopost_channels", autopost_channels)
-    await save_dict("pending_autoposts", pending_autoposts, "post_id")
-    await save_dict("admins", admins)
-
-    for name in counters:
-        await save_counter(name, counters[name])
+    written, deleted = await users.flush()
+    await ledger.compact()
+    for table, data, key_col in (
+        ("products", products, "product_id"),
+        ("tickets", tickets, "ticket_id"),
+        ("raffles", raffles, "raffle_id"),
+        ("banned_users", banned_users, "user_id"),
+        ("group_data", group_data, "chat_id"),
+        ("pending_autoposts", pending_autoposts, "post_id"),
+        ("admins", admins, "user_id"),
+    ):
+        w, d = await flush_dict(table, data, key_col)
+        written += w
+        deleted += d
+    for table, data in (
+        ("reviews", reviews),
+        ("channels_required", channels_required),
+        ("autopost_channels", autopost_channels),
+    ):
+        w, d = await flush_list(table, data)
+        written += w
+        deleted += d
+
+    await backend.save_counters(counters)
+
+    autosave_stats["cycles"] += 1
+    autosave_stats["last_rows"] = written
+    autosave_stats["last_deleted"] = deleted
+    autosave_stats["total_rows"] += written
+    autosave_stats["total_deleted"] += deleted
+    logging.info(f"Автосейв: записано строк {written}, удалено {deleted}")
 
 # Автосейв каждую минуту
 scheduler.add_job(autosave, "interval", seconds=60, id="autosave")
 
 async def load_all_data():
-    global counters
-    await init_db()
-
-    await load_dict("users", dict_global=users)
-    await load_dict("products", "product_id", products)
-    await load_dict("tickets", "ticket_id", tickets)
-    await load_dict("raffles", "raffle_id", raffles)
-    await load_list("reviews", reviews)
-    await load_list("channels_required", channels_required)
-    await load_dict("banned_users", dict_global=banned_users)
-    await load_dict("group_data", "chat_id", group_data)
-    await load_list("autopost_channels", autopost_channels)
-    await load_dict("pending_autoposts", "post_id", pending_autoposts)
-    await load_dict("admins", "user_id", admins)
-
-    # Загружаем счётчики
-    counters["product"] = await load_counter("product", 1)
-    counters["ticket"] = await load_counter("ticket", 1)
-    counters["raffle"] = await load_counter("raffle", 1)
-    counters["autopost"] = await load_counter("autopost", 1)
+    await backend.init()
+
+    replayed = await ledger.replay()
+    if replayed:
+        logging.warning(f"Ledger: переиграно {replayed} изменений баланса после аварийной остановки")
+    # Пользователи не грузятся целиком: UserRepository читает их по требованию.
+    # Остальные таблицы независимы — читаем их параллельно (у SQLite — каждую своим соединением)
+    started = time.perf_counter()
+    loaded = await asyncio.gather(
+        load_dict("products", "product_id", products),
+        load_dict("tickets", "ticket_id", tickets),
+        load_dict("raffles", "raffle_id", raffles),
+        load_list("reviews", reviews),
+        load_list("channels_required", channels_required),
+        load_dict("banned_users", dict_global=banned_users),
+        load_dict("group_data", "chat_id", group_data),
+        load_list("autopost_channels", autopost_channels),
+        load_dict("pending_autoposts", "post_id", pending_autoposts),
+        load_dict("admins", "user_id", admins),
+        load_counters({"product": 1, "ticket": 1, "raffle": 1, "autopost": 1,
+                       "reminder_cursor": 0, "reminder_done": 0}),
+    )
+    counters.update(loaded[-1])
+    # Переносит сообщения из tickets, поэтому только после их загрузки
+    await migrate_ticket_messages()
+    logging.info(f"Загрузка таблиц: {(time.perf_counter() - started) * 1000:.1f} мс")
 
     # Если админов нет — добавляем владельца
     if not admins and ADMIN_IDS:
         admins[ADMIN_IDS[0]] = 3
-        await save_dict("admins", admins)
+        await flush_dict("admins", admins)
 
     logging.info("Все данные успешно загружены из базы")
 
+# ====================== BACKUPS ======================
+BACKUP_DIR = "backups"
+BACKUP_KEEP = 7                # сколько последних копий хранить
+BACKUP_INTERVAL_HOURS = 24
+BACKUP_PAGES_PER_STEP = 256    # страниц за шаг backup API
+BACKUP_STEP_SLEEP = 0.005      # пауза между шагами, сек
+BACKUP_MAX_RESTARTS = 5        # после стольких рестартов копируем за один шаг
+
+_backup_lock = asyncio.Lock()
+
+
+class _BackupRestarts(Exception):
+    pass
+
+
+def _backup_blocking(src_path: str, dst_path: str) -> int:
+    """Онлайн-копия БД в отдельном потоке. Возвращает число рестартов."""
+    restarts = 0
+    last = None
+
+    def progress(status, remaining, total):
+        # Запись в источник другим соединением перезапускает копирование
+        nonlocal restarts, last
+        if last is not None and remaining > last:
+            restarts += 1
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarts()
+        last = remaining
+
+    src = sqlite3.connect(src_path)
+    try:
+        dst = sqlite3.connect(dst_path)
+        try:
+            try:
+                src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=progress, sleep=BACKUP_STEP_SLEEP)
+            except _BackupRestarts:
+                # В WAL чтение за один шаг не блокирует писателей
+                src.backup(dst, pages=-1)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    return restarts
+
+
+def rotate_backups(keep: int | None = None) -> list[str]:
+    keep = BACKUP_KEEP if keep is None else keep
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    files = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith("bot_database_") and f.endswith(".db"))
+    removed = files[:-keep] if keep > 0 else files
+    for name in removed:
+        os.remove(os.path.join(BACKUP_DIR, name))
+    return removed
+
+
+async def backup_database() -> tuple[str, int, float]:
+    """Копия БД в BACKUP_DIR без остановки бота: (путь, размер, секунды)."""
+    if not isinstance(backend, SqliteBackend):
+        raise RuntimeError(f"бэкап поддерживается только для SqliteBackend, а не {type(backend).__name__}")
+    async with _backup_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        path = os.path.join(BACKUP_DIR, f"bot_database_{datetime.now():%Y%m%d_%H%M%S}.db")
+        tmp_path = path + ".part"
+        started = time.perf_counter()
+        try:
+            restarts = await asyncio.to_thread(_backup_blocking, DB_PATH, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        duration = time.perf_counter() - started
+        size = os.path.getsize(path)
+        removed = rotate_backups()
+        logging.info(
+            f"Бэкап: {path}, {size / 1024 / 1024:.1f} МБ за {duration:.2f} с "
+            f"(рестартов {restarts}, удалено старых {len(removed)})"
+        )
+        return path, size, duration
+
+
+async def scheduled_backup():
+    if not isinstance(backend, SqliteBackend):
+        return   # копировать нечего: данные не в DB_PATH
+    try:
+        await backup_database()
+    except Exception as e:
+        logging.error(f"Ошибка бэкапа: {e}")
+
+scheduler.add_job(scheduled_backup, "interval", hours=BACKUP_INTERVAL_HOURS, id="backup")
+
+
+@router.message(Command("backup"))
+async def cmd_backup(message: Message):
+    if admins.get(message.from_user.id, 0) < 3:
+        await message.reply("Доступно только владельцу!")
+        return
+    await message.reply("Создаю бэкап базы...")
+    try:
+        path, size, duration = await backup_database()
+    except Exception as e:
+        await message.reply(f"Ошибка бэкапа: {e}")
+        return
+    await message.reply(f"Бэкап готов: <code>{path}</code>\nРазмер: {size / 1024 / 1024:.1f} МБ, время: {duration:.2f} с")
+
+# ====================== BROADCASTS ======================
+# Рассылка — задание в broadcast_jobs: текст, аудитория, курсор по user_id.
+# Идёт фоном порциями по BROADCAST_BATCH через outbox (общий лимит скорости),
+# до BROADCAST_CONCURRENCY отправок одновременно. Доставки порции и курсор
+# пишутся одной транзакцией, поэтому после перезапуска рассылка продолжается
+# со следующей порции.
+BROADCAST_BATCH = 200
+BROADCAST_CONCURRENCY = 20
+BROADCAST_AUDIENCES = ("all", "admins")
+BROADCAST_RETRY_DELAY = 30   # сек — пауза обработчика после ошибки хранилища
+
+_broadcast_task: asyncio.Task | None = None
+_broadcast_stopping = False
+
+async def get_broadcast_job(job_id: int | None = None) -> dict | None:
+    """Задание по id; без id — последнее созданное."""
+    row = await backend.get_broadcast(job_id)
+    return dict(zip(BROADCAST_COLUMNS, row)) if row else None
+
+async def set_broadcast_status(job_id: int, status: str):
+    await backend.set_broadcast_status(job_id, status)
+
+async def _broadcast_audience(audience: str, after: int, limit: int) -> list[tuple[int, int | None]]:
+    """Следующие получатели после after: [(user_id, unreachable_at), ...]."""
+    if audience == "admins":
+        return [(uid, None) for uid in sorted(uid for uid in admins if uid > after)[:limit]]
+    return await users.reach_after(after, limit)
+
+async def start_broadcast(text: str, audience: str = "all", created_by: int | None = None) -> int:
+    total = len(admins) if audience == "admins" else await users.count()
+    job_id = await backend.create_broadcast(text, audience, total, created_by, int(time.time()))
+    logging.info(f"Рассылка #{job_id}: создана, аудитория {audience}, получателей {total}")
+    ensure_broadcast_runner()
+    return job_id
+
+def ensure_broadcast_runner():
+    """Запускает фоновый обработчик рассылок, если он ещё не работает."""
+    global _broadcast_task
+    if _broadcast_task is None or _broadcast_task.done():
+        _broadcast_task = asyncio.get_running_loop().create_task(_run_broadcasts())
+        _broadcast_task.add_done_callback(_broadcast_runner_done)
+
+def _broadcast_runner_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Обработчик рассылок упал: {task.exception()!r}; задания остались в running")
+
+async def stop_broadcast_runner(timeout: float = 15):
+    """Даёт текущей порции дописаться при остановке бота, чтобы не слать её повторно."""
+    global _broadcast_stopping
+    if _broadcast_task is None or _broadcast_task.done():
+        return
+    _broadcast_stopping = True
+    try:
+        await asyncio.wait_for(asyncio.shield(_broadcast_task), timeout)
+    except asyncio.TimeoutError:
+        _broadcast_task.cancel()
+
+async def _run_broadcasts():
+    send_lane.set("bulk")   # контекст этой фоновой задачи
+    while not _broadcast_stopping:
+        try:
+            job_id = await backend.running_broadcast_id()
+        except Exception as e:
+            logging.error(f"Рассылки: не удалось прочитать задания, повтор через {BROADCAST_RETRY_DELAY} с: {e}")
+            await asyncio.sleep(BROADCAST_RETRY_DELAY)
+            continue
+        if job_id is None:
+            return
+        try:
+            await _run_broadcast_job(await get_broadcast_job(job_id))
+        except Exception as e:
+            logging.error(f"Рассылка #{job_id}: ошибка, ставлю на паузу: {e}")
+            try:
+                await set_broadcast_status(job_id, "paused")
+            except Exception as e:
+                # Задание осталось running — продолжим его с сохранённого курсора после паузы
+                logging.error(f"Рассылка #{job_id}: не удалось поставить на паузу, повтор через "
+                              f"{BROADCAST_RETRY_DELAY} с: {e}")
+                await asyncio.sleep(BROADCAST_RETRY_DELAY)
+
+async def _run_broadcast_job(job: dict):
+    job_id = job["id"]
+    slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    after = job["cursor"]
+
+    async def deliver(user_id, unreachable_at):
+        async with slots:
+            try:
+                if not await bulk_send(user_id, unreachable_at, "send_message", job["text"]):
+                    return job_id, user_id, "skipped", None, int(time.time())
+                return job_id, user_id, "sent", None, int(time.time())
+            except Exception as e:
+                return job_id, user_id, "failed", str(e)[:200], int(time.time())
+
+    while True:
+        current = await get_broadcast_job(job_id)
+        if current is None or current["status"] != "running" or _broadcast_stopping:
+            return   # пауза, отмена или остановка бота — курсор уже сохранён
+        recipients = await _broadcast_audience(job["audience"], after, BROADCAST_BATCH)
+        if not recipients:
+            await backend.set_broadcast_status(job_id, "done", int(time.time()))
+            logging.info(f"Рассылка #{job_id}: завершена, отправлено {current['sent']}, ошибок {current['failed']}")
+            return
+        rows = await asyncio.gather(*(deliver(*recipient) for recipient in recipients))
+        sent = sum(1 for row in rows if row[2] == "sent")
+        skipped = sum(1 for row in rows if row[2] == "skipped")
+        after = recipients[-1][0]
+        await backend.save_broadcast_batch(job_id, rows, after, sent, len(rows) - sent - skipped, skipped)
+
+def broadcast_status_text(job: dict) -> str:
+    done = job["sent"] + job["failed"] + job["skipped"]
+    percent = done / job["total"] * 100 if job["total"] else 100
+    text = (f"Рассылка #{job['id']} — {job['status']}\n"
+            f"Аудитория: {job['audience']}\n"
+            f"Отправлено: {job['sent']}, ошибок: {job['failed']}, пропущено недоступных: {job['skipped']} "
+            f"из {job['total']} ({percent:.0f}%)")
+    if job["status"] == "running" and job["created"] and done:
+        elapsed = time.time() - job["created"]
+        left = max(0, job["total"] - done) * elapsed / done
+        text += f"\nОсталось примерно {left / 60:.0f} мин"
+    return text
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    if admins.get(message.from_user.id, 0) < 3:
+        await message.reply("Доступно только владельцу!")
+        return
+    usage = ("Использование:\n"
+             "/broadcast start <текст> — всем пользователям\n"
+             "/broadcast test <текст> — только админам\n"
+             "/broadcast pause|resume|cancel [id]\n"
+             "/broadcast status [id]")
+    parts = (command.args or "").strip().split(maxsplit=1)
+    if not parts:
+        await message.reply(usage)
+        return
+    action, rest = parts[0].lower(), parts[1] if len(parts) > 1 else ""
+
+    if action in ("start", "test"):
+        if not rest:
+            await message.reply(usage)
+            return
+        job_id = await start_broadcast(rest, "all" if action == "start" else "admins", message.from_user.id)
+        await message.reply(broadcast_status_text(await get_broadcast_job(job_id)))
+        return
+
+    if action not in ("pause", "resume", "cancel", "status"):
+        await message.reply(usage)
+        return
+    job = await get_broadcast_job(int(rest) if rest.isdigit() else None)
+    if job is None:
+        await message.reply("Рассылок ещё не было")
+        return
+    if action in ("pause", "cancel") and job["status"] in ("running", "paused"):
+        await set_broadcast_status(job["id"], "paused" if action == "pause" else "cancelled")
+    elif action == "resume" and job["status"] == "paused":
+        await set_broadcast_status(job["id"], "running")
+        ensure_broadcast_runner()
+    await message.reply(broadcast_status_text(await get_broadcast_job(job["id"])))
+
+# Регистрируется до группового catch-all, иначе /ticket в группе до него не доходит
+@router.message(Command("ticket"))
+async def cmd_ticket_lookup(message: Message, command: CommandObject):
+    # Любой тикет по номеру: из памяти или из архива
+    if admins.get(message.from_user.id, 0) < 1:
+        return
+    if not command.args or not command.args.strip().lstrip("#").isdigit():
+        await message.reply("Использование: /ticket <номер>")
+        return
+    t_id = int(command.args.strip().lstrip("#"))
+    if t_id in tickets:
+        t = tickets[t_id]
+        text = ticket_text(t_id, t, await load_ticket_messages(t_id))
+    else:
+        t = await load_archived_ticket(t_id)
+        if t is None:
+            await message.reply("Тикет не найден")
+            return
+        text = "📦 Из архива\n" + ticket_text(t_id, t, t.get("messages", []))
+    status = "открыт" if t.get("open") else "закрыт"
+    await message.reply(f"{text}Статус: {status}", parse_mode="HTML")
+
+# ====================== METRICS ======================
+def metrics_text() -> str:
+    sub_total = sub_cache_stats["hits"] + sub_cache_stats["misses"]
+    lines = [
+        "📊 Метрики\n",
+        f"Подписки (кэш): попаданий {sub_cache_stats['hits']}, промахов {sub_cache_stats['misses']}"
+        f" ({sub_cache_stats['hits'] / sub_total * 100 if sub_total else 0:.0f}% hit), "
+        f"сбросов {sub_cache_stats['invalidations']}, записей {len(_sub_cache)}",
+        f"Индекс подписчиков: событий {membership_stats['events']}, ответов из индекса "
+        f"{membership_stats['index_hits']}, запросов к API {membership_stats['api_fallbacks']}, "
+        f"каналов с апдейтами {len(membership_live)}",
+    ]
+    lines += [f"get_chat_member {ch_id}: {stats.summary()}" for ch_id, stats in channel_latency.items()]
+    lines.append(f"Апдейт целиком: {update_latency.summary()}")
+    lines.append(
+        f"Уведомления админам: рассылок {notify_stats['batches']}, доставлено {notify_stats['sent']}, "
+        f"не доставлено {notify_stats['failed']}"
+    )
+    lines.append(
+        f"Очередь отправки: в очереди {outbox.depth}, поставлено {outbox.stats['queued']}, "
+        f"отправлено {outbox.stats['sent']}, повторов {outbox.stats['retried']}, "
+        f"ошибок {outbox.stats['failed']}; ожидание {outbox.latency.summary()}"
+    )
+    lines += [
+        f"Полоса {lane}: в outbox {outbox.lane_depth[lane]}, ждут лимита {api_limiter.waiting[lane]}; "
+        f"очередь {outbox.lane_latency[lane].summary()}; лимит {api_limiter.wait_latency[lane].summary()}"
+        for lane in LANES
+    ]
+    lines += [f"Участок {name}: {stats.summary()}" for name, stats in span_latency.items()]
+    lines += [f"API {name}: {stats.summary()}" for name, stats in sorted(request_latency.items())]
+    lines.append(
+        "Ошибки API: " + (", ".join(f"{kind} {n}" for kind, n in sorted(request_errors.items())) or "нет")
+        + f"; ожиданий паузы retry_after {api_limiter.waited}"
+    )
+    lines += [
+        f"Пользователи (LRU): {len(users)} в памяти, попаданий {users.stats['hits']}, "
+        f"промахов {users.stats['misses']}, вытеснено {users.stats['evictions']}, возвращено {users.stats['reattached']}",
+        f"Автосейв: циклов {autosave_stats['cycles']}, строк в последнем {autosave_stats['last_rows']}",
+        f"Журнал балансов: записей {ledger.stats['records']}, commit'ов {ledger.stats['commits']}, "
+        f"ошибок {ledger.stats['errors']}",
+        f"Напоминания: обходов {reminder_stats['sweeps']}, в текущем пройдено {counters.get('reminder_done', 0)}, "
+        f"проверено {reminder_stats['checked']}, отправлено {reminder_stats['sent']}, ошибок {reminder_stats['failed']}",
+        f"Уведомления по тикетам: сообщений {ticket_notify_stats['messages']}, "
+        f"уведомлений {ticket_notify_stats['notifications']}, правок {ticket_notify_stats['edits']}, "
+        f"переотправлено {ticket_notify_stats['resent']}, "
+        f"сэкономлено отправок {ticket_notify_stats['saved']}",
+        f"Недоступные: помечено {reach_stats['marked']}, снято {reach_stats['cleared']}, "
+        f"пропущено {reach_stats['skipped']}, перепроверено {reach_stats['rechecked']}",
+    ]
+    return "\n".join(lines)
+
+@router.message(Command("metrics"))
+async def cmd_metrics(message: Message):
+    if admins.get(message.from_user.id, 0) < 3:
+        return
+    await message.reply(metrics_text())
+
 # ====================== SCHEDULER TASKS ======================
+# Напоминания о подписке: раз в REMINDER_TICK_SECONDS обрабатывается очередной
+# срез пользователей после курсора, так что полный обход растянут на
+# REMINDER_SWEEP_MINUTES. Срез не больше REMINDER_SLICE_MAX — столько успевает
+# уйти за тик при REMINDER_RATE с запасом; при большей базе обход длится
+# пользователи / REMINDER_SLICE_MAX тиков (при 20/с и тике 60 с — ~58 тыс. в час).
+# Курсор лежит в counters и переживает перезапуск.
+REMINDER_SWEEP_MINUTES = 60
+REMINDER_TICK_SECONDS = 60
+REMINDER_RATE = 20            # сообщений в секунду на все напоминания
+REMINDER_SLICE_MAX = int(REMINDER_RATE * REMINDER_TICK_SECONDS * 0.8)
+
+reminder_bucket = TokenBucket(REMINDER_RATE)
+reminder_stats = {"sweeps": 0, "checked": 0, "sent": 0, "failed": 0}
+
 async def send_reminders():
-    for user_id in list(users.keys()):
-        if not await is_subscribed(bot, user_id):
-            try:
-                kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_sub")]])
-                await bot.send_message(user_id, 
-                    "🔔 Напоминание!\n\n" + subscription_text(),
-                    reply_markup=kb)
-            except:
-                pass
+    if not channels_required:
+        return
+    send_lane.set("bulk")   # у каждого запуска job своя задача — полоса не утечёт
+    total = await users.count()
+    ticks = max(1, REMINDER_SWEEP_MINUTES * 60 // REMINDER_TICK_SECONDS)
+    slice_size = min(max(1, -(-total // ticks)), REMINDER_SLICE_MAX)
+    cursor = counters.get("reminder_cursor", 0)
+    if cursor == 0:
+        sweep_minutes = -(-total // slice_size) * REMINDER_TICK_SECONDS / 60
+        logging.info(f"Напоминания: новый обход, пользователей {total}, займёт ~{sweep_minutes:.0f} мин")
+    rows = await users.reach_after(cursor, slice_size)
+    ids = [user_id for user_id, _ in rows]
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_sub")]])
+    sent = 0
+    for user_id, unreachable_at in rows:
+        reminder_stats["checked"] += 1
+        if not due_for_contact(unreachable_at):
+            reach_stats["skipped"] += 1
+            continue
+        if await is_subscribed(bot, user_id):
+            continue
+        await reminder_bucket.acquire()
+        try:
+            if await bulk_send(user_id, unreachable_at, "send_message",
+                               "🔔 Напоминание!\n\n" + subscription_text(), reply_markup=kb):
+                sent += 1
+        except Exception:
+            reminder_stats["failed"] += 1
+    reminder_stats["sent"] += sent
+
+    done = counters.get("reminder_done", 0) + len(ids)
+    if len(ids) < slice_size:
+        # Дошли до конца — следующий срез начнёт новый обход
+        reminder_stats["sweeps"] += 1
+        logging.info(f"Напоминания: обход завершён, проверено {done}")
+        counters["reminder_cursor"], counters["reminder_done"] = 0, 0
+    else:
+        counters["reminder_cursor"], counters["reminder_done"] = ids[-1], done
+        logging.info(f"Напоминания: {done}/{total} ({done / total * 100:.0f}%), отправлено в срезе {sent}")
+    await save_counter("reminder_cursor", counters["reminder_cursor"])
+    await save_counter("reminder_done", counters["reminder_done"])
 
 async def check_raffles():
     now = datetime.now()
@@ -543,8 +2954,343 @@ async def check_raffles():
         if raffle["ends_at"] <= now and not raffle["finished"]:
             await finish_raffle(r_id)
 
-scheduler.add_job(send_reminders, 'interval', minutes=60)
+# Срез, не успевший за тик (медленные проверки подписки), не запускается внахлёст со следующим
+scheduler.add_job(send_reminders, 'interval', seconds=REMINDER_TICK_SECONDS, id="reminders",
+                  max_instances=1, coalesce=True)
 scheduler.add_job(check_raffles, 'interval', minutes=60)
+scheduler.add_job(archive_old_records, 'interval', hours=24, id="archive")
+
+# ====================== OUTBOUND QUEUE ======================
+# Все bot.send_*/forward_message идут через outbox: общий лимит и полосы — у
+# api_limiter, не больше OUTBOX_CHAT_RATE в один чат. Общую паузу на retry_after
+# ставит ErrorClassifyMiddleware в api_limiter; outbox лишь повторяет само
+# сообщение не раньше retry_after, очередь ограничена OUTBOX_MAX_DEPTH. Чаты с готовыми
+# сообщениями лежат в куче своей полосы по времени, когда им снова можно
+# писать, — занятый чат не задерживает остальных. Из готовых полос выбирается
+# та, что меньше всего получила с учётом LANE_WEIGHT (bulk уступает остальным,
+# но не голодает). В одном чате порядок сообщений сохраняется.
+OUTBOX_CHAT_RATE = 1
+OUTBOX_MAX_DEPTH = 10_000
+OUTBOX_CONCURRENCY = 8       # одновременных запросов к API
+OUTBOX_MAX_RETRIES = 3
+
+
+class OutboundQueue:
+    def __init__(self, chat_rate: float = OUTBOX_CHAT_RATE,
+                 max_depth: int = OUTBOX_MAX_DEPTH, concurrency: int = OUTBOX_CONCURRENCY):
+        self.chat_interval = 1 / chat_rate
+        self.max_depth = max_depth
+        self.concurrency = concurrency
+        self.depth = 0
+        self._chats = {}          # chat_id -> deque заданий
+        self._busy = set()        # чаты, у которых запрос уже в полёте
+        self._next_at = {}        # chat_id -> когда можно писать снова (monotonic)
+        self._ready = {lane: [] for lane in LANES}   # куча (когда, порядковый номер, chat_id)
+        self._pass = dict.fromkeys(LANES, 0.0)      # сколько полоса получила, в долях веса
+        self._vtime = 0.0
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._slots = None
+        self._worker = None
+        self.latency = LatencyStats()    # от постановки в очередь до отправки
+        self.lane_latency = {lane: LatencyStats() for lane in LANES}
+        self.lane_depth = dict.fromkeys(LANES, 0)
+        self.stats = {"queued": 0, "sent": 0, "retried": 0, "failed": 0}
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    def _schedule(self, chat_id, at: float):
+        self._seq += 1
+        lane = self._chats[chat_id][0][7]   # чат ждёт в полосе своего первого сообщения
+        heapq.heappush(self._ready[lane], (at, self._seq, chat_id))
+        self._wakeup.set()
+
+    def _enqueue(self, method: str, chat_id, args, kwargs, future):
+        lane = send_lane.get()
+        queue = self._chats.setdefault(chat_id, deque())
+        queue.append([method, chat_id, args, kwargs, future, time.monotonic(), 0, lane])
+        self.depth += 1
+        self.lane_depth[lane] += 1
+        self.stats["queued"] += 1
+        if len(queue) == 1 and chat_id not in self._busy:
+            self._schedule(chat_id, self._next_at.get(chat_id, 0.0))
+        self._ensure_worker()
+
+    async def send(self, method: str, chat_id, *args, **kwargs):
+        """Ставит bot.<method>(chat_id, ...) в очередь полосы send_lane и ждёт результата (исключения пробрасываются)."""
+        while self.depth >= self.max_depth:
+            self._space.clear()
+            await self._space.wait()
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(method, chat_id, args, kwargs, future)
+        return await future
+
+    def _ready_lanes(self, now: float) -> list[str]:
+        return [lane for lane in LANES if self._ready[lane] and self._ready[lane][0][0] <= now]
+
+    def _pick_lane(self, ready: list[str]) -> str | None:
+        if not ready:
+            return None
+        for lane in ready:
+            # Простаивавшая полоса не копит долг: начинает с текущего «времени»
+            self._pass[lane] = max(self._pass[lane], self._vtime)
+        lane = min(ready, key=self._pass.__getitem__)
+        self._vtime = self._pass[lane]
+        self._pass[lane] += 1 / LANE_WEIGHT[lane]
+        return lane
+
+    async def _run(self):
+        while True:
+            heads = [queue[0][0] for queue in self._ready.values() if queue]
+            if not heads:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = min(heads) - time.monotonic()
+            if delay > 0:
+                # Новое сообщение может оказаться готовым раньше — просыпаемся и по нему
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.monotonic()
+            ready = self._ready_lanes(now)
+            # Токен берётся до выбора сообщения: воркер не держит вынутое bulk-сообщение,
+            # пока лимитер отдаёт токены интерактивной полосе, — после паузы выбор повторяется
+            lane = self._pick_lane([lane for lane in ready if api_limiter.can_take(lane)])
+            if lane is None:
+                await api_limiter.wait_turn(ready[0])
+                continue
+            at, _, chat_id = heapq.heappop(self._ready[lane])
+            api_limiter.take(lane, now - max(at, self._chats[chat_id][0][5]))
+            if len(self._next_at) > self.max_depth:
+                self._next_at = {c: t for c, t in self._next_at.items() if t > now}
+            await self._slots.acquire()
+            self._busy.add(chat_id)
+            asyncio.get_running_loop().create_task(self._deliver(chat_id))
+
+    async def _deliver(self, chat_id):
+        queue = self._chats[chat_id]
+        item = queue[0]
+        method, _, args, kwargs, future, queued_at, attempts, lane = item
+        retry_at = None
+        send_lane.set(lane)
+        _send_paced.set(True)
+        try:
+            result = await getattr(bot, method)(chat_id, *args, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempts < OUTBOX_MAX_RETRIES:
+                item[6] += 1
+                self.stats["retried"] += 1
+                retry_at = time.monotonic() + e.retry_after   # паузу всем уже поставил api_limiter
+                logging.warning(f"Outbox: retry_after {e.retry_after} с (чат {chat_id})")
+            else:
+                self._finish(queue, item, error=e)
+        except Exception as e:
+            self._finish(queue, item, error=e)
+        else:
+            self.stats["sent"] += 1
+            self.latency.add(time.monotonic() - queued_at)
+            self.lane_latency[lane].add(time.monotonic() - queued_at)
+            self._finish(queue, item, result=result)
+        finally:
+            self._slots.release()
+            self._busy.discard(chat_id)
+            self._next_at[chat_id] = retry_at or time.monotonic() + self.chat_interval
+            if queue:
+                self._schedule(chat_id, self._next_at[chat_id])
+            else:
+                del self._chats[chat_id]
+
+    def _finish(self, queue, item, result=None, error=None):
+        queue.popleft()
+        self.depth -= 1
+        self.lane_depth[item[7]] -= 1
+        self._space.set()
+        future = item[4]
+        if error is not None:
+            self.stats["failed"] += 1
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def drain(self, timeout: float = 10):
+        """Ждёт, пока очередь опустеет (при остановке бота)."""
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+outbox = OutboundQueue()
+
+# Уведомления админам: хендлер не ждёт рассылку — она идёт фоном, параллельно,
+# не больше NOTIFY_CONCURRENCY отправок одновременно. Недоставленные
+# собираются отдельно и пишутся в лог одной строкой.
+NOTIFY_CONCURRENCY = 10
+notify_stats = {"batches": 0, "sent": 0, "failed": 0}
+_notify_tasks = set()
+
+def notify_admins(text: str, min_level: int = 1, reply_markup=None,
+                  forward_from: tuple[int, int] | None = None, sent: dict | None = None, **kwargs) -> asyncio.Task:
+    """Рассылает text админам с уровнем >= min_level. forward_from=(chat_id, message_id) — сначала переслать.
+
+    Возвращает фоновую задачу; её результат — [(admin_id, ошибка), ...] недоставленных.
+    sent, если передан, заполняется {admin_id: message_id} доставленных уведомлений.
+    """
+    recipients = [admin_id for admin_id, level in admins.items() if level >= min_level]
+    task = asyncio.get_running_loop().create_task(
+        _notify_admins(recipients, text, reply_markup, forward_from, sent, kwargs)
+    )
+    _notify_tasks.add(task)
+    task.add_done_callback(_notify_tasks.discard)
+    return task
+
+async def _notify_admins(recipients, text, reply_markup, forward_from, sent, kwargs):
+    send_lane.set("admin")
+    slots = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def deliver(admin_id):
+        async with slots:
+            if forward_from is not None:
+                await outbox.send("forward_message", admin_id, *forward_from)
+            message = await outbox.send("send_message", admin_id, text, reply_markup=reply_markup, **kwargs)
+            if sent is not None and message is not None:
+                sent[admin_id] = message.message_id
+
+    results = await asyncio.gather(*(deliver(admin_id) for admin_id in recipients), return_exceptions=True)
+    failures = [(admin_id, r) for admin_id, r in zip(recipients, results) if isinstance(r, Exception)]
+    notify_stats["batches"] += 1
+    notify_stats["sent"] += len(recipients) - len(failures)
+    notify_stats["failed"] += len(failures)
+    if failures:
+        logging.warning(
+            f"Уведомление админам: не доставлено {len(failures)} из {len(recipients)}: "
+            + ", ".join(f"{admin_id} ({type(e).__name__})" for admin_id, e in failures)
+        )
+    return failures
+
+# ====================== REACHABILITY ======================
+# Пользователь, заблокировавший бота или удалённый, помечается unreachable_at
+# (это делает ErrorClassifyMiddleware на любой отправке в личку). Массовые рассылки таких пропускают и пробуют снова не чаще раза в
+# UNREACHABLE_RECHECK_DAYS; /start снимает отметку сразу.
+UNREACHABLE_RECHECK_DAYS = 7
+reach_stats = {"marked": 0, "cleared": 0, "skipped": 0, "rechecked": 0}
+
+def is_unreachable_error(e: Exception) -> bool:
+    if isinstance(e, TelegramForbiddenError):
+        return True
+    return isinstance(e, TelegramBadRequest) and "chat not found" in str(e).lower()
+
+def due_for_contact(unreachable_at: int | None) -> bool:
+    """Можно ли писать пользователю в массовой рассылке."""
+    return not unreachable_at or time.time() - unreachable_at >= UNREACHABLE_RECHECK_DAYS * 86400
+
+async def mark_unreachable(user_id: int):
+    user = await users.get(user_id)
+    if user is not None:
+        user["unreachable_at"] = int(time.time())
+        reach_stats["marked"] += 1
+
+async def mark_reachable(user_id: int, user: dict | None = None):
+    user = user if user is not None else await users.get(user_id)
+    if user is not None and user.get("unreachable_at"):
+        user["unreachable_at"] = None
+        reach_stats["cleared"] += 1
+
+async def bulk_send(user_id: int, unreachable_at: int | None, method: str, *args, **kwargs) -> bool:
+    """Отправка в массовой рассылке. False — пользователь пропущен как недоступный."""
+    if not due_for_contact(unreachable_at):
+        reach_stats["skipped"] += 1
+        return False
+    if unreachable_at:
+        reach_stats["rechecked"] += 1
+    await outbox.send(method, user_id, *args, **kwargs)
+    if unreachable_at:
+        await mark_reachable(user_id)
+    return True
+
+async def notify_user(user_id: int, text: str, **kwargs) -> bool:
+    """Служебное уведомление пользователю (выигрыш, выдача, бан): недоступных пропускает, ошибки не пробрасывает."""
+    user = await users.get(user_id)
+    return await notify_known(user_id, user.get("unreachable_at") if user else None, text, **kwargs)
+
+async def notify_known(user_id: int, unreachable_at: int | None, text: str, **kwargs) -> bool:
+    """Как notify_user, но unreachable_at уже прочитан (users.reach_of) — профиль не загружается."""
+    try:
+        return await bulk_send(user_id, unreachable_at, "send_message", text, **kwargs)
+    except Exception as e:
+        logging.warning(f"Уведомление {user_id} не доставлено: {type(e).__name__}: {e}")
+        return False
+
+# ====================== MIDDLEWARES ======================
+# Время обработки апдейта целиком и по участкам (span) — для /metrics
+update_latency = LatencyStats()
+span_latency: dict[str, LatencyStats] = {}
+
+class latency_span:
+    """with latency_span("subscription"): ... — замер участка обработки апдейта."""
+
+    def __init__(self, name: str):
+        self.stats = span_latency.setdefault(name, LatencyStats())
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.add(time.perf_counter() - self.started)
+        if exc_type is not None:
+            self.stats.errors += 1
+        return False
+
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[Any, dict], Awaitable[Any]], event, data: dict):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            update_latency.errors += 1
+            raise
+        finally:
+            update_latency.add(time.perf_counter() - started)
+
+
+# Проверка подписки — один раз на callback, до хендлеров. В data["subscribed"]
+# кладётся результат; None — не проверялось (админ или callback из белого списка).
+SUB_GATE_WHITELIST = {"check_sub", "back_main", "stars_paid", "card_paid"}
+SUB_GATE_WHITELIST_PREFIXES = ("admin", "approve_", "reject_")
+
+class SubscriptionMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[Any, dict], Awaitable[Any]], event: CallbackQuery, data: dict):
+        callback = event.data or ""
+        user_id = event.from_user.id
+        if (callback in SUB_GATE_WHITELIST or callback.startswith(SUB_GATE_WHITELIST_PREFIXES)
+                or admins.get(user_id, 0) >= 1):
+            data["subscribed"] = None
+            return await handler(event, data)
+        with latency_span("subscription"):
+            subscribed = await is_subscribed(bot, user_id)
+        data["subscribed"] = subscribed
+        if not subscribed:
+            kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_sub")]])
+            await event.answer()
+            if event.message:
+                await event.message.answer(subscription_text(), reply_markup=kb)
+            return None
+        return await handler(event, data)
+
+
+dp.update.outer_middleware(UpdateTimingMiddleware())
+router.callback_query.outer_middleware(SubscriptionMiddleware())
 
 # ====================== START & SUBSCRIPTION ======================
 @router.message(Command("start"))
@@ -555,18 +3301,18 @@ async def cmd_start(message: Message):
         return
     username = message.from_user.username or ""
     full_name = message.from_user.full_name
+    now_ts = int(time.time())
 
-    if user_id not in users:
-        users[user_id] = {
-            "balance": 0,
-            "stars": 0,
-            "purchases": [],
-            "username": username,
-            "name": full_name,
-            "tickets": [],
-            "banned": False,
-            "warns": {}
-        }
+    u = await users.get(user_id)
+    if u is None:
+        await users.create(user_id, new_user_profile(username, full_name))
+    else:
+        u["last_seen"] = now_ts
+        await mark_reachable(user_id, u)
+        if u.get("username") != username:
+            u["username"] = username
+        if u.get("name") != full_name:
+            u["name"] = full_name
 
     level = admins.get(user_id, 0)
     subscribed = await is_subscribed(bot, user_id)
@@ -590,6 +3336,8 @@ async def cmd_start(message: Message):
 
 @router.callback_query(F.data == "check_sub")
 async def check_sub(call: CallbackQuery):
+    # Пользователь говорит, что подписался — спрашиваем Telegram заново
+    invalidate_subscription(call.from_user.id)
     subscribed = await is_subscribed(bot, call.from_user.id)
     if subscribed:
         await call.message.edit_text(
@@ -599,12 +3347,21 @@ async def check_sub(call: CallbackQuery):
     else:
         await call.answer("❌ Ты ещё не подписался на все каналы!", show_alert=True)
 
+@router.chat_member()
+async def on_channel_member_update(update: ChatMemberUpdated):
+    # Подписки/отписки в обязательных каналах (бот должен быть админом канала)
+    if not any(ch["channel_id"] == update.chat.id for ch in channels_required):
+        return
+    membership_live.add(update.chat.id)
+    membership_stats["events"] += 1
+    user_id = update.new_chat_member.user.id
+    record_membership(update.chat.id, user_id, _is_member_status(update.new_chat_member))
+    _sub_cache.pop((user_id, update.chat.id), None)
+
 # ====================== PROFILE ======================
 @router.callback_query(F.data == "profile")
 async def profile(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
-    u = users.get(call.from_user.id, {})
+    u = await users.get(call.from_user.id, {})
     purchases = len(u.get("purchases", []))
     text = f"👤 Твой профиль\n\n" \
            f"💰 Баланс: {u.get('balance', 0)} ₽\n" \
@@ -616,8 +3373,6 @@ async def profile(call: CallbackQuery):
 # ====================== SHOP ======================
 @router.callback_query(F.data == "shop")
 async def shop_main(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
     if not products:
         await call.message.edit_text("🛒 Магазин пока пустует.\nСкоро появятся товары! 🌟",
                                     reply_markup=start_kb(call.from_user.id))
@@ -633,20 +3388,21 @@ async def shop_main(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("buy_"))
 async def buy_product(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
     product_id = int(call.data.split("_")[1])
     product = products.get(product_id)
     if not product:
         await call.answer("❌ Товар не найден!", show_alert=True)
         return
 
-    user = users[call.from_user.id]
+    user = await users.get(call.from_user.id)
+    if user is None:
+        await call.answer("Нажми /start", show_alert=True)
+        return
     if user["balance"] < product["price"]:
         await call.answer("❌ Недостаточно средств!", show_alert=True)
         return
 
-    user["balance"] -= product["price"]
+    change_balance(call.from_user.id, user, "balance", -product["price"], f"buy:{product_id}")
     user["purchases"].append({
         "id": product_id,
         "name": product["name"],
@@ -661,19 +3417,17 @@ async def buy_product(call: CallbackQuery):
 
     # Выдача товара
     if product["type"] == "text":
-        await bot.send_message(call.from_user.id, f"📝 {product['content']}")
+        await outbox.send("send_message", call.from_user.id, f"📝 {product['content']}")
     elif product["type"] == "link":
-        await bot.send_message(call.from_user.id, f"🔗 Ссылка: {product['content']}")
+        await outbox.send("send_message", call.from_user.id, f"🔗 Ссылка: {product['content']}")
     elif product["type"] == "file":
-        await bot.send_document(call.from_user.id, FSInputFile(product["content"]))
+        await outbox.send("send_document", call.from_user.id, FSInputFile(product["content"]))
     elif product["type"] == "video":
-        await bot.send_video(call.from_user.id, product["content"])
+        await outbox.send("send_video", call.from_user.id, product["content"])
 
 # ====================== REVIEWS ======================
 @router.callback_query(F.data == "reviews")
 async def show_reviews(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
     if not reviews:
         kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✍️ Оставить отзыв", callback_data="leave_review")]])
         await call.message.edit_text("⭐ Ещё никто не оставил отзыв.\nБудь первым! 🌟", reply_markup=kb)
@@ -693,8 +3447,6 @@ async def show_reviews(call: CallbackQuery):
 
 @router.callback_query(F.data == "leave_review")
 async def leave_review_rating(call: CallbackQuery, state: FSMContext):
-    if not await check_subscription_and_prompt(call.message):
-        return
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="★☆☆☆☆ 1", callback_data="rate_1"),
          InlineKeyboardButton(text="★★☆☆☆ 2", callback_data="rate_2"),
@@ -728,8 +3480,6 @@ async def save_review(message: Message, state: FSMContext):
 # ====================== SUPPORT ======================
 @router.callback_query(F.data == "support")
 async def support_menu(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
     kb = [
         [InlineKeyboardButton(text="⭐ Отправить звезду админу", callback_data="send_star")],
         [InlineKeyboardButton(text="💳 Пополнить баланс бота", callback_data="send_money")],
@@ -743,29 +3493,22 @@ async def support_menu(call: CallbackQuery):
 
 @router.callback_query(F.data == "send_star")
 async def send_star(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
-    user = users.get(call.from_user.id, {})
+    user = await users.get(call.from_user.id, {})
     if user.get("stars", 0) <= 0:
         await call.answer("❌ У тебя нет звёздочек!", show_alert=True)
         return
-    user["stars"] -= 1
+    change_balance(call.from_user.id, user, "stars", -1, "donate_star")
     await call.message.edit_text("🌟 Спасибо! Админ получил твою звезду! ❤️")
     
-    for admin_id, level in admins.items():
-        if level == 3:
-            try:
-                await bot.send_message(admin_id,
-                    f"⭐ Новый донат — звезда!\n"
-                    f"От: {call.from_user.full_name} (@{call.from_user.username or 'нет'})\n"
-                    f"Осталось у юзера: {user['stars']}")
-            except:
-                pass
+    notify_admins(
+        f"⭐ Новый донат — звезда!\n"
+        f"От: {call.from_user.full_name} (@{call.from_user.username or 'нет'})\n"
+        f"Осталось у юзера: {user['stars']}",
+        min_level=3
+    )
 
 @router.callback_query(F.data == "send_money")
 async def send_money_start(call: CallbackQuery, state: FSMContext):
-    if not await check_subscription_and_prompt(call.message):
-        return
     await call.message.edit_text("💳 Сколько рублей перевести на развитие бота?\n(введи число)")
     await state.set_state(AdminStates.edit_user_balance)  # Переиспользуем
 
@@ -782,31 +3525,26 @@ async def send_money_finish(message: Message, state: FSMContext):
         await message.answer("❌ Введи нормальное число!")
         return
 
-    user = users[message.from_user.id]
-    if user["balance"] < amount:
+    user = await users.get(message.from_user.id)
+    if user is None or user["balance"] < amount:
         await message.answer("❌ Недостаточно средств на балансе!")
         return
 
-    user["balance"] -= amount
+    change_balance(message.from_user.id, user, "balance", -amount, "donate")
     await message.answer(f"🙏 Спасибо огромное за {amount} ₽!\n"
                          f"Это очень помогает развитию бота! 🚀")
 
-    for admin_id, level in admins.items():
-        if level == 3:
-            try:
-                await bot.send_message(admin_id,
-                    f"💳 Новый донат — {amount} ₽!\n"
-                    f"От: {message.from_user.full_name} (@{message.from_user.username or 'нет'})\n"
-                    f"Остаток у юзера: {user['balance']} ₽")
-            except:
-                pass
+    notify_admins(
+        f"💳 Новый донат — {amount} ₽!\n"
+        f"От: {message.from_user.full_name} (@{message.from_user.username or 'нет'})\n"
+        f"Остаток у юзера: {user['balance']} ₽",
+        min_level=3
+    )
     await state.clear()
 
 # ====================== TICKETS ======================
 @router.callback_query(F.data == "tickets")
 async def user_tickets(call: CallbackQuery, state: FSMContext):
-    if not await check_subscription_and_prompt(call.message):
-        return
     await call.message.edit_text("🎫 Напиши свой вопрос — я передам администрации!",
                                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="◀ Назад", callback_data="back_main")]]))
     await state.set_state(UserStates.ticket)
@@ -817,21 +3555,14 @@ async def user_ticket_message(message: Message, state: FSMContext):
     t_id = counters["ticket"]
     counters["ticket"] += 1
 
-    tickets[t_id] = {
+    # Тикет сразу пишется в БД вместе с первым сообщением
+    await create_ticket(t_id, {
         "id": t_id,
         "user_id": message.from_user.id,
         "username": message.from_user.username or "без юзернейма",
         "name": message.from_user.full_name,
-        "messages": [],
         "open": True
-    }
-
-    # Первое сообщение
-    tickets[t_id]["messages"].append({
-        "text": message.text,
-        "from": "user",
-        "date": datetime.now().strftime("%d.%m %H:%M")
-    })
+    }, "user", message.text, datetime.now().strftime("%d.%m %H:%M"))
 
     await message.answer("Тикет создан!\nТеперь можешь писать сюда — админ ответит")
     await state.clear()
@@ -839,20 +3570,18 @@ async def user_ticket_message(message: Message, state: FSMContext):
     await state.update_data(current_ticket=t_id)
 
     # Уведомление админу
-    for admin_id in admins:
-        try:
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Ответить", callback_data=f"answer_ticket_{t_id}")],
-                [InlineKeyboardButton(text="Закрыть тикет", callback_data=f"close_ticket_{t_id}")]
-            ])
-            await bot.send_message(admin_id,
-                f"НОВЫЙ ТИКЕТ #{t_id}\n\n"
-                f"От: <b>{message.from_user.full_name}</b>\n"
-                f"@{message.from_user.username or 'без юзернейма'}\n"
-                f"ID: <code>{message.from_user.id}</code>\n\n"
-                f"{message.text}",
-                reply_markup=kb)
-        except: pass
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Ответить", callback_data=f"answer_ticket_{t_id}")],
+        [InlineKeyboardButton(text="Закрыть тикет", callback_data=f"close_ticket_{t_id}")]
+    ])
+    notify_admins(
+        f"НОВЫЙ ТИКЕТ #{t_id}\n\n"
+        f"От: <b>{html.escape(message.from_user.full_name)}</b>\n"
+        f"@{message.from_user.username or 'без юзернейма'}\n"
+        f"ID: <code>{message.from_user.id}</code>\n\n"
+        f"{html.escape(message.text or '')}",
+        reply_markup=kb
+    )
 
 @router.message(StateFilter(UserStates.chatting))
 async def user_chat_in_ticket(message: Message, state: FSMContext):
@@ -865,27 +3594,105 @@ async def user_chat_in_ticket(message: Message, state: FSMContext):
         return
 
     # Сохраняем сообщение
-    tickets[t_id]["messages"].append({
-        "text": message.text,
-        "from": "user",
-        "date": datetime.now().strftime("%H:%M")
-    })
+    await add_ticket_message(t_id, "user", message.text, datetime.now().strftime("%H:%M"))
 
     await message.answer("Сообщение отправлено админу")
 
-    # Пересылаем админам
-    for admin_id in admins:
-        try:
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Ответить", callback_data=f"answer_ticket_{t_id}")],
-                [InlineKeyboardButton(text="Закрыть тикет", callback_data=f"close_ticket_{t_id}")]
-            ])
-            await bot.send_message(admin_id,
-                f"СООБЩЕНИЕ В ТИКЕТЕ #{t_id}\n\n"
-                f"От: <b>{tickets[t_id]['name']}</b>\n"
-                f"{message.text}",
-                reply_markup=kb)
-        except: pass
+    # Админам — не сразу, а сводкой (см. queue_ticket_notification)
+    queue_ticket_notification(t_id, message.text)
+
+# Сообщения пользователя в тикете копятся TICKET_DEBOUNCE_SECONDS и уходят
+# админам одним уведомлением. Пока последнее уведомление свежее
+# (TICKET_EDIT_WINDOW) и текст влезает, новые строки дописываются в него
+# правкой. Ответ или «Ответить» админа сбрасывают сводку — следующее
+# сообщение придёт новым уведомлением (правка не даёт звука).
+TICKET_DEBOUNCE_SECONDS = 5
+TICKET_EDIT_WINDOW = 120
+TICKET_NOTIFY_MAX_LEN = 3500
+ticket_notify_stats = {"messages": 0, "notifications": 0, "edits": 0, "resent": 0, "saved": 0}
+_ticket_digests = {}   # t_id -> {"pending", "shown", "sent": {admin_id: message_id}, "sent_at", "task", "gen"}
+
+def ticket_admin_kb(t_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Ответить", callback_data=f"answer_ticket_{t_id}")],
+        [InlineKeyboardButton(text="Закрыть тикет", callback_data=f"close_ticket_{t_id}")]
+    ])
+
+def queue_ticket_notification(t_id: int, text: str):
+    digest = _ticket_digests.setdefault(
+        t_id, {"pending": [], "shown": [], "sent": {}, "sent_at": 0.0, "task": None, "gen": 0}
+    )
+    digest["pending"].append(html.escape(text or ""))   # уведомление в HTML: один «<» сломал бы всю сводку
+    ticket_notify_stats["messages"] += 1
+    if digest["task"] is None:
+        digest["task"] = asyncio.get_running_loop().create_task(_flush_ticket_digest(t_id, digest))
+        _notify_tasks.add(digest["task"])
+        digest["task"].add_done_callback(_notify_tasks.discard)
+
+def reset_ticket_digest(t_id: int, closed: bool = False):
+    """Следующие сообщения тикета — новым уведомлением; closed — забыть тикет совсем."""
+    digest = _ticket_digests.pop(t_id, None) if closed else _ticket_digests.get(t_id)
+    if digest is not None:
+        digest["shown"], digest["sent"] = [], {}
+        digest["gen"] += 1   # доставка, что сейчас в полёте, не должна вернуть старую сводку
+
+async def _flush_ticket_digest(t_id: int, digest: dict):
+    send_lane.set("admin")
+    try:
+        while digest["pending"]:
+            await asyncio.sleep(TICKET_DEBOUNCE_SECONDS)
+            lines, digest["pending"] = digest["pending"], []
+            await _deliver_ticket_digest(t_id, digest, lines)
+    except Exception as e:
+        logging.error(f"Уведомление по тикету #{t_id} не отправлено: {e}")
+    finally:
+        digest["task"] = None
+
+async def _deliver_ticket_digest(t_id: int, digest: dict, lines: list[str]):
+    ticket = tickets.get(t_id)
+    if ticket is None or not ticket.get("open") or _ticket_digests.get(t_id) is not digest:
+        return
+    header = f"СООБЩЕНИЕ В ТИКЕТЕ #{t_id}\n\nОт: <b>{html.escape(ticket['name'])}</b>\n"
+    kb = ticket_admin_kb(t_id)
+    shown = digest["shown"] + lines
+    text = header + "\n".join(shown)
+    recipients = sum(1 for level in admins.values() if level >= 1)
+    gen = digest["gen"]
+
+    if digest["sent"] and time.monotonic() - digest["sent_at"] < TICKET_EDIT_WINDOW \
+            and len(text) <= TICKET_NOTIFY_MAX_LEN:
+        targets = list(digest["sent"].items())
+        results = await asyncio.gather(*(
+            bot.edit_message_text(text, chat_id=admin_id, message_id=message_id, reply_markup=kb)
+            for admin_id, message_id in targets
+        ), return_exceptions=True)
+        # Правка не прошла (сообщение удалили, retry_after, устарело) — этому админу
+        # всё целиком новым уведомлением, иначе новые строки до него не дойдут
+        failed = [admin_id for (admin_id, _), result in zip(targets, results) if isinstance(result, Exception)]
+        resent = await asyncio.gather(*(
+            outbox.send("send_message", admin_id, text, reply_markup=kb) for admin_id in failed
+        ), return_exceptions=True)
+        for admin_id, message in zip(failed, resent):
+            if isinstance(message, Exception):
+                logging.warning(f"Тикет #{t_id}: уведомление админу {admin_id} не доставлено: {message}")
+        if digest["gen"] == gen:
+            for admin_id, message in zip(failed, resent):
+                if isinstance(message, Exception):
+                    digest["sent"].pop(admin_id, None)
+                else:
+                    digest["sent"][admin_id] = message.message_id
+            digest["shown"] = shown
+        ticket_notify_stats["edits"] += len(targets) - len(failed)
+        ticket_notify_stats["resent"] += len(failed)
+        ticket_notify_stats["saved"] += len(lines) * recipients - len(targets)
+        return
+
+    sent = {}
+    await notify_admins(header + "\n".join(lines), reply_markup=kb, sent=sent)
+    if digest["gen"] == gen:
+        digest.update(shown=lines, sent=sent, sent_at=time.monotonic())
+    ticket_notify_stats["notifications"] += 1
+    ticket_notify_stats["saved"] += (len(lines) - 1) * recipients
 
 @router.callback_query(F.data.startswith("answer_ticket_"))
 async def answer_ticket_start(call: CallbackQuery, state: FSMContext):
@@ -900,6 +3707,7 @@ async def answer_ticket_start(call: CallbackQuery, state: FSMContext):
         return
 
     await state.update_data(admin_ticket=t_id)
+    reset_ticket_digest(t_id)   # это уведомление сейчас станет формой ответа
     await call.message.edit_text(
         f"Ответ в тикет #{t_id}\n\n"
         f"Пользователь: {tickets[t_id]['name']}\n\n"
@@ -926,14 +3734,11 @@ async def admin_send_answer(message: Message, state: FSMContext):
 
     user_id = tickets[t_id]["user_id"]
 
-    tickets[t_id]["messages"].append({
-        "text": message.text,
-        "from": "admin",
-        "date": datetime.now().strftime("%H:%M")
-    })
+    await add_ticket_message(t_id, "admin", message.text, datetime.now().strftime("%H:%M"))
+    reset_ticket_digest(t_id)
 
     try:
-        await bot.send_message(user_id,
+        await outbox.send("send_message", user_id,
             f"ОТВЕТ ОТ АДМИНИСТРАЦИИ\n\n"
             f"{message.text}\n\n"
             f"Тикет #{t_id} • Пиши, если остались вопросы!")
@@ -956,11 +3761,13 @@ async def close_ticket(call: CallbackQuery):
 
     user_id = tickets[t_id]["user_id"]
     tickets[t_id]["open"] = False
+    tickets[t_id]["closed_at"] = datetime.now()
+    reset_ticket_digest(t_id, closed=True)
 
     await call.message.edit_text(f"Тикет #{t_id} закрыт")
 
     try:
-        await bot.send_message(user_id,
+        await outbox.send("send_message", user_id,
             f"Тикет #{t_id} закрыт администратором\n\n"
             "Спасибо за обращение! Если будут вопросы — создавай новый")
     except: pass
@@ -968,8 +3775,6 @@ async def close_ticket(call: CallbackQuery):
 # ====================== RAFFLES ======================
 @router.callback_query(F.data == "raffles")
 async def raffles_list(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
     text = "🎲 Активные розыгрыши\n\n"
     kb = []
     active = False
@@ -986,8 +3791,6 @@ async def raffles_list(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("join_raffle_"))
 async def join_raffle(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
     r_id = int(call.data.split("_")[2])
     if r_id not in raffles or raffles[r_id].get("finished"):
         await call.answer("❌ Розыгрыш завершён!", show_alert=True)
@@ -999,6 +3802,8 @@ async def join_raffle(call: CallbackQuery):
     else:
         await call.answer("ℹ️ Ты уже участвуешь!")
 
+RAFFLE_NOTIFY_BATCH = 500   # уведомлений об итогах розыгрыша за одну порцию
+
 async def finish_raffle(r_id: int):
     raffle = raffles[r_id]
     participants = raffle["participants"]
@@ -1017,6 +3822,7 @@ async def finish_raffle(r_id: int):
     
     raffle["winners"] = winners
     raffle["finished"] = True
+    raffle["finished_at"] = datetime.now()
     
     text = f"🎉 Розыгрыш #{r_id} завершён!\n\n" \
            f"Призов: {prize_count}\n" \
@@ -1024,26 +3830,22 @@ async def finish_raffle(r_id: int):
     if winners:
         text += "🏆 Победители:\n"
         for w in winners:
-            user = users.get(w, {"name": "Unknown"})
+            user = await users.get(w, {"name": "Unknown"})
             text += f"• {user.get('name', f'ID{w}')}\n"
-            try:
-                await bot.send_message(w, f"🎊 Поздравляем! Ты выиграл в розыгрыше #{r_id}! 🏆")
-            except:
-                pass
     else:
         text += "😔 Никто не выиграл :("
-    
-    for p in participants:
-        try:
-            await bot.send_message(p, text)
-        except:
-            pass
 
-    for admin_id in admins:
-        try:
-            await bot.send_message(admin_id, f"🔥 Розыгрыш #{r_id} завершён! Победителей: {len(winners)}")
-        except:
-            pass
+    # Участников могут быть десятки тысяч: недоступность читается порциями одним
+    # запросом, а не профилем на каждого, и порция уходит в outbox целиком
+    sends = [(w, f"🎊 Поздравляем! Ты выиграл в розыгрыше #{r_id}! 🏆") for w in winners]
+    sends += [(p, text) for p in participants]
+    with in_lane("bulk"):
+        for start in range(0, len(sends), RAFFLE_NOTIFY_BATCH):
+            batch = sends[start:start + RAFFLE_NOTIFY_BATCH]
+            reach = await users.reach_of({uid for uid, _ in batch})
+            await asyncio.gather(*(notify_known(uid, reach.get(uid), message) for uid, message in batch))
+
+    notify_admins(f"🔥 Розыгрыш #{r_id} завершён! Победителей: {len(winners)}")
 
 # ====================== ADMIN PANEL ======================
 @router.callback_query(F.data == "admin_panel")
@@ -1168,8 +3970,9 @@ async def grant_balance_confirm(call: CallbackQuery, state: FSMContext):
     uid = data["grant_id"]
     t = data["grant_type"]
     amt = data["grant_amount"]
-    if uid in users:
-        users[uid][t] += amt
+    user = await users.get(uid)
+    if user is not None:
+        change_balance(uid, user, t, amt, f"grant:{call.from_user.id}")
     else:
         await call.answer("Пользователь не найден")
         return
@@ -1269,16 +4072,12 @@ async def cmd_ban_bot(message: Message, command: CommandObject):
     )
 
     # Уведомляем забаненного
-    try:
-        await bot.send_message(
-            uid,
-            f"Вы забанены в боте.\n"
-            f"Срок: {term}\n"
-            f"Причина: нарушение правил\n"
-            f"Забанил: {message.from_user.first_name}"
-        )
-    except:
-        pass  # заблокировал бота
+    await notify_user(uid,
+        f"Вы забанены в боте.\n"
+        f"Срок: {term}\n"
+        f"Причина: нарушение правил\n"
+        f"Забанил: {message.from_user.first_name}"
+    )
 
 @router.message(Command("unban"))
 async def cmd_unban(message: Message, command: CommandObject):
@@ -1499,16 +4298,13 @@ async def automod(message: Message):
     if is_spam_message(message.text or ""):
         await message.delete()
         banned_users[user_id] = {'reason': 'Spam/link', 'until': None}
-        for admin_id in admins:
-            await bot.send_message(admin_id, f"Spam detected from {user_id} in {chat_id}: {message.text}")
+        notify_admins(f"Spam detected from {user_id} in {chat_id}: {message.text}")
         await bot.ban_chat_member(chat_id, user_id)
 
 # ====================== AUTOPOSTING ======================
 # === НОВЫЙ АВТОПОСТИНГ С ПОКУПКОЙ ===
 @router.callback_query(F.data == "autoposting")
 async def autoposting_menu(call: CallbackQuery):
-    if not await check_subscription_and_prompt(call.message):
-        return
 
     if not autopost_channels:
         await call.message.edit_text("Автопостинг временно недоступен — каналы не настроены.")
@@ -1566,7 +4362,7 @@ async def autopost_receive_content(message: Message, state: FSMContext):
 
     if is_paid:
         total_cost = sum(ch.get("cost", 0) for ch in autopost_channels if ch.get("cost", 0) > 0)
-        user = users[message.from_user.id]
+        user = await users.get(message.from_user.id, {"balance": 0})
 
         if user["balance"] < total_cost:
             await message.answer(f"Недостаточно средств! Нужно {total_cost} ₽, у тебя {user['balance']} ₽")
@@ -1574,20 +4370,20 @@ async def autopost_receive_content(message: Message, state: FSMContext):
             return
 
         # Списываем деньги
-        user["balance"] -= total_cost
+        change_balance(message.from_user.id, user, "balance", -total_cost, "autopost")
 
         # Публикуем сразу
         published = 0
         for ch in autopost_channels:
             try:
                 if message.photo:
-                    await bot.send_photo(ch["channel_id"], message.photo[-1].file_id, caption=message.caption)
+                    await outbox.send("send_photo", ch["channel_id"], message.photo[-1].file_id, caption=message.caption)
                 elif message.video:
-                    await bot.send_video(ch["channel_id"], message.video.file_id, caption=message.caption)
+                    await outbox.send("send_video", ch["channel_id"], message.video.file_id, caption=message.caption)
                 elif message.document:
-                    await bot.send_document(ch["channel_id"], message.document.file_id, caption=message.caption)
+                    await outbox.send("send_document", ch["channel_id"], message.document.file_id, caption=message.caption)
                 else:
-                    await bot.send_message(ch["channel_id"], message.text or "Пост от пользователя")
+                    await outbox.send("send_message", ch["channel_id"], message.text or "Пост от пользователя")
                 published += 1
             except:
                 pass
@@ -1612,17 +4408,12 @@ async def autopost_receive_content(message: Message, state: FSMContext):
         await message.answer("Твой пост отправлен на модерацию! Ожидай уведомления.")
 
         # Уведомляем админов (уровень 2+)
-        for admin_id, lvl in admins.items():
-            if lvl >= 2:
-                try:
-                    kb = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="Опубликовать", callback_data=f"approve_post_{post_id}"),
-                         InlineKeyboardButton(text="Отклонить", callback_data=f"reject_post_{post_id}")]
-                    ])
-                    await bot.forward_message(admin_id, message.chat.id, message.message_id)
-                    await bot.send_message(admin_id, f"Новый пост на модерацию #{post_id}", reply_markup=kb)
-                except:
-                    pass
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Опубликовать", callback_data=f"approve_post_{post_id}"),
+             InlineKeyboardButton(text="Отклонить", callback_data=f"reject_post_{post_id}")]
+        ])
+        notify_admins(f"Новый пост на модерацию #{post_id}", min_level=2, reply_markup=kb,
+                      forward_from=(message.chat.id, message.message_id))
 
     await state.clear()
 
@@ -1768,19 +4559,12 @@ async def stars_paid_pressed(call: CallbackQuery):
          InlineKeyboardButton(text="Отклонить", callback_data=f"reject_{request_id}")]
     ])
 
-    for admin_id, level in admins.items():
-        if level >= 2:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"Заявка: звёзды @buwse\n"
-                    f"От: <a href='tg://user?id={user_id}'>пользователь</a>\n"
-                    f"Проверь платежи в @buwse",
-                    reply_markup=kb,
-                    parse_mode="HTML"
-                )
-            except:
-                pass
+    notify_admins(
+        f"Заявка: звёзды @buwse\n"
+        f"От: <a href='tg://user?id={user_id}'>пользователь</a>\n"
+        f"Проверь платежи в @buwse",
+        min_level=2, reply_markup=kb, parse_mode="HTML"
+    )
 
     await call.message.edit_text("Заявка отправлена админам.\nОжидай зачисления звёзд.")
     await call.answer()
@@ -1812,19 +4596,12 @@ async def card_paid_pressed(call: CallbackQuery):
          InlineKeyboardButton(text="Отклонить", callback_data=f"reject_{request_id}")]
     ])
 
-    for admin_id, level in admins.items():
-        if level >= 2:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"Заявка: перевод на карту\n"
-                    f"От: <a href='tg://user?id={user_id}'>пользователь</a>\n"
-                    f"Проверь поступление",
-                    reply_markup=kb,
-                    parse_mode="HTML"
-                )
-            except:
-                pass
+    notify_admins(
+        f"Заявка: перевод на карту\n"
+        f"От: <a href='tg://user?id={user_id}'>пользователь</a>\n"
+        f"Проверь поступление",
+        min_level=2, reply_markup=kb, parse_mode="HTML"
+    )
 
     await call.message.edit_text("Заявка отправлена админам.\nОжидай зачисления.")
     await call.answer()
@@ -1847,10 +4624,10 @@ async def process_request(call: CallbackQuery):
     req_type = data["type"]
 
     if action == "approve":
-        await bot.send_message(user_id, "Платёж подтверждён!\nЗвёзды зачислены на баланс.")
+        await outbox.send("send_message", user_id, "Платёж подтверждён!\nЗвёзды зачислены на баланс.")
         await call.message.edit_text(f"ЗАЧИСЛЕНО\nID: {user_id}\nТип: {req_type}")
     else:
-        await bot.send_message(user_id, "Платёж не найден или отклонён.\nПопробуй снова.")
+        await outbox.send("send_message", user_id, "Платёж не найден или отклонён.\nПопробуй снова.")
         await call.message.edit_text(f"ОТКЛОНЕНО\nID: {user_id}")
 
     await call.answer()
@@ -1887,13 +4664,10 @@ async def stars_paid_pressed(call: CallbackQuery):
          InlineKeyboardButton(text="Отклонить", callback_data=f"reject_{request_id}")]
     ])
 
-    for admin_id, level in admins.items():
-        if level >= 2:
-            try:
-                await bot.send_message(admin_id,
-                    f"Заявка на звёзды\nОт: <a href='tg://user?id={user_id}'>юзер</a>\nПроверь @buwse",
-                    reply_markup=kb, parse_mode="HTML")
-            except: pass
+    notify_admins(
+        f"Заявка на звёзды\nОт: <a href='tg://user?id={user_id}'>юзер</a>\nПроверь @buwse",
+        min_level=2, reply_markup=kb, parse_mode="HTML"
+    )
 
     await call.message.edit_text("Заявка отправлена админам. Ожидай зачисления звёзд.")
     await call.answer()
@@ -1921,13 +4695,10 @@ async def card_paid_pressed(call: CallbackQuery):
          InlineKeyboardButton(text="Отклонить", callback_data=f"reject_{request_id}")]
     ])
 
-    for admin_id, level in admins.items():
-        if level >= 2:
-            try:
-                await bot.send_message(admin_id,
-                    f"Заявка на рубли\nОт: <a href='tg://user?id={user_id}'>юзер</a>\nПроверь карту",
-                    reply_markup=kb, parse_mode="HTML")
-            except: pass
+    notify_admins(
+        f"Заявка на рубли\nОт: <a href='tg://user?id={user_id}'>юзер</a>\nПроверь карту",
+        min_level=2, reply_markup=kb, parse_mode="HTML"
+    )
 
     await call.message.edit_text("Заявка отправлена админам. Ожидай зачисления.")
     await call.answer()
@@ -1949,10 +4720,10 @@ async def process_request(call: CallbackQuery):
     del pending_requests[request_id]
 
     if action == "approve":
-        await bot.send_message(user_id, "Платёж подтверждён!\nЗвёзды зачислены на баланс.")
+        await outbox.send("send_message", user_id, "Платёж подтверждён!\nЗвёзды зачислены на баланс.")
         await call.message.edit_text(f"ЗАЧИСЛЕНО\nID: {user_id}")
     else:
-        await bot.send_message(user_id, "Платёж не найден или отклонён.\nПопробуй снова.")
+        await outbox.send("send_message", user_id, "Платёж не найден или отклонён.\nПопробуй снова.")
         await call.message.edit_text(f"ОТКЛОНЕНО\nID: {user_id}")
 
     await call.answer()
@@ -1971,11 +4742,10 @@ async def show_users_page(message: Message, state: FSMContext):
     data = await state.get_data()
     page = data.get("page", 0)
     per_page = 5
-    user_list = list(users.items())
-    total = len(user_list)
+    total = await users.count()
     start = page * per_page
     end = start + per_page
-    page_users = user_list[start:end]
+    page_users = await users.page(start, per_page)
 
     if not page_users:
         await message.edit_text("Пользователей нет", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
@@ -2030,32 +4800,34 @@ async def users_nav(call: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.regexp(r"^grant_rub_(\d+)$"))
 async def quick_grant_rub(call: CallbackQuery):
     uid = int(call.data.split("_")[-1])
-    if uid not in users: return
-    users[uid]["balance"] += 500  # можно поменять
+    user = await users.get(uid)
+    if user is None: return
+    change_balance(uid, user, "balance", 500, f"grant:{call.from_user.id}")  # можно поменять
     await call.answer(f"+500₽ пользователю {uid}")
-    await bot.send_message(uid, "Вам выдали 500₽ на баланс!")
+    await notify_user(uid, "Вам выдали 500₽ на баланс!")
 
 @router.callback_query(F.data.regexp(r"^grant_star_(\d+)$"))
 async def quick_grant_star(call: CallbackQuery):
     uid = int(call.data.split("_")[-1])
-    if uid not in users: return
-    users[uid]["stars"] += 100
+    user = await users.get(uid)
+    if user is None: return
+    change_balance(uid, user, "stars", 100, f"grant:{call.from_user.id}")
     await call.answer(f"+100 звёзд пользователю {uid}")
-    await bot.send_message(uid, "Вам выдали 100 звёзд!")
+    await notify_user(uid, "Вам выдали 100 звёзд!")
 
 @router.callback_query(F.data.regexp(r"^make_admin_(\d+)$"))
 async def quick_make_admin(call: CallbackQuery):
     uid = int(call.data.split("_")[-1])
     admins[uid] = 2  # модератор
     await call.answer(f"Пользователь {uid} теперь модератор")
-    await bot.send_message(uid, "Вы назначены модератором!")
+    await notify_user(uid, "Вы назначены модератором!")
 
 @router.callback_query(F.data.regexp(r"^ban_user_(\d+)$"))
 async def quick_ban(call: CallbackQuery):
     uid = int(call.data.split("_")[-1])
     banned_users[uid] = {"reason": "По решению админа", "until": None}
     await call.answer(f"Пользователь {uid} забанен")
-    await bot.send_message(uid, "Вы забанены в боте навсегда.")
+    await notify_user(uid, "Вы забанены в боте навсегда.")
 
 # ——— ТИКЕТЫ ———
 @router.callback_query(F.data == "admin_tickets")
@@ -2073,6 +4845,13 @@ async def admin_tickets_list(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="Назад", callback_data="admin_panel"))
     await call.message.edit_text("Открытые тикеты:", reply_markup=kb.as_markup())
 
+def ticket_text(t_id: int, t: dict, messages: list[dict]) -> str:
+    text = f"Тикет #{t_id}\nОт: {t['name']} (@{t.get('username','—')})\n\n"
+    for m in messages:
+        sender = "Вы" if m["from"] == "admin" else t['name']
+        text += f"<b>{sender}:</b> {m['text']}\n\n"
+    return text
+
 @router.callback_query(F.data.regexp(r"^ticket_(\d+)$"))
 async def show_ticket_admin(call: CallbackQuery):
     t_id = int(call.data.split("_")[1])
@@ -2080,10 +4859,7 @@ async def show_ticket_admin(call: CallbackQuery):
         await call.answer("Тикет закрыт")
         return
     t = tickets[t_id]
-    text = f"Тикет #{t_id}\nОт: {t['name']} (@{t.get('username','—')})\n\n"
-    for m in t["messages"]:
-        sender = "Вы" if m["from"] == "admin" else t['name']
-        text += f"<b>{sender}:</b> {m['text']}\n\n"
+    text = ticket_text(t_id, t, await load_ticket_messages(t_id))
 
     kb = [
         [InlineKeyboardButton(text="Ответить", callback_data=f"answer_ticket_{t_id}")],
@@ -2104,6 +4880,30 @@ async def admin_raffles_list(call: CallbackQuery):
     kb.append([InlineKeyboardButton(text="Назад", callback_data="admin_panel")])
     await call.message.edit_text("Розыгрыши:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
 
+@router.callback_query(F.data.startswith("view_raffle_"))
+async def view_raffle(call: CallbackQuery):
+    if admins.get(call.from_user.id, 0) < 1:
+        await call.answer("Только для админов!", show_alert=True)
+        return
+    r_id = int(call.data.split("_")[2])
+    r = raffles.get(r_id)
+    archived = False
+    if r is None:
+        r = await load_archived_raffle(r_id)
+        archived = True
+    if r is None:
+        await call.answer("Розыгрыш не найден", show_alert=True)
+        return
+    text = f"Розыгрыш #{r_id}{' (архив)' if archived else ''}\n\n" \
+           f"Призов: {r.get('prize_count', 0)}\n" \
+           f"Участников: {len(r.get('participants', []))}\n"
+    if r.get("ends_at"):
+        text += f"Окончание: {r['ends_at']:%d.%m.%Y %H:%M}\n"
+    if r.get("finished"):
+        text += f"Победители: {', '.join(str(w) for w in r.get('winners', [])) or 'нет'}\n"
+    kb = [[InlineKeyboardButton(text="Назад", callback_data="admin_raffles")]]
+    await call.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+
    # ====================== КАНАЛЫ — РАБОТАЕТ В AIOGRAM 3.X БЕЗ iter_dialogs ======================
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
@@ -2194,18 +4994,13 @@ async def process_channel_link(message: Message, state: FSMContext):
     )
 
     # Уведомление всем админам
-    for admin_id in admins.keys():
-        try:
-            await bot.send_message(
-                admin_id,
-                f"НОВЫЙ ОБЯЗАТЕЛЬНЫЙ КАНАЛ\n\n"
-                f"<b>{chat.title}</b>\n"
-                f"ID: <code>{chat.id}</code>\n"
-                f"Добавил: {message.from_user.first_name}",
-                parse_mode="HTML"
-            )
-        except:
-            pass
+    notify_admins(
+        f"НОВЫЙ ОБЯЗАТЕЛЬНЫЙ КАНАЛ\n\n"
+        f"<b>{chat.title}</b>\n"
+        f"ID: <code>{chat.id}</code>\n"
+        f"Добавил: {message.from_user.first_name}",
+        parse_mode="HTML"
+    )
 
     await state.clear()
 
@@ -2216,6 +5011,7 @@ async def delete_channel(call: CallbackQuery):
     ch_id = int(call.data.split("_")[-1])
     was = len(channels_required)
     channels_required[:] = [ch for ch in channels_required if ch["channel_id"] != ch_id]
+    forget_channel_membership(ch_id)
 
     if len(channels_required) < was:
         await call.message.edit_text(
@@ -2553,15 +5349,17 @@ async def show_reviews_page(message: Message, state: FSMContext):
     text = f"<b>Управление отзывами</b> ({total} всего)\n\n"
     kb = InlineKeyboardBuilder()
 
-    for idx, r in enumerate(page_reviews, start=start):
+    for r in page_reviews:
         username = r.get("username", "Аноним")
         stars = "★" * r["rating"] + "☆" * (5 - r["rating"])
         short_text = (r["text"][:70] + "...") if len(r["text"]) > 70 else r["text"]
-        text += f"<b>{idx + 1}.</b> <b>{username}</b> {stars}\n{short_text}\n\n"
+        text += f"<b>#{r['id']}</b> <b>{username}</b> {stars}\n{short_text}\n\n"
 
+        # Кнопки ссылаются на id строки, а не на позицию в списке:
+        # удаление другого отзыва не сдвигает их
         kb.row(InlineKeyboardButton(
-            text=f"Удалить #{idx + 1}",
-            callback_data=f"del_review_{idx}"
+            text=f"Удалить #{r['id']}",
+            callback_data=f"del_review_{r['id']}"
         ))
 
     # Навигация
@@ -2591,18 +5389,18 @@ async def reviews_nav(call: CallbackQuery, state: FSMContext):
 # Удаление с подтверждением
 @router.callback_query(F.data.regexp(r"^del_review_(\d+)$"))
 async def confirm_delete_review(call: CallbackQuery, state: FSMContext):
-    review_idx = int(call.data.split("_")[2])
-    if review_idx >= len(reviews):
+    review_id = int(call.data.split("_")[2])
+    review = reviews.get(review_id)
+    if review is None:
         await call.answer("Отзыв уже удалён", show_alert=True)
         return
 
-    review = reviews[review_idx]
     username = review.get("username", "Аноним")
     stars = "★" * review["rating"] + "☆" * (5 - review["rating"])
     short = (review["text"][:100] + "...") if len(review["text"]) > 100 else review["text"]
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="ДА, УДАЛИТЬ", callback_data=f"confirm_del_{review_idx}")],
+        [InlineKeyboardButton(text="ДА, УДАЛИТЬ", callback_data=f"confirm_del_{review_id}")],
         [InlineKeyboardButton(text="Отмена", callback_data="admin_reviews")]
     ])
 
@@ -2617,12 +5415,12 @@ async def confirm_delete_review(call: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data.regexp(r"^confirm_del_(\d+)$"))
 async def do_delete_review(call: CallbackQuery, state: FSMContext):
-    idx = int(call.data.split("_")[2])
-    if idx >= len(reviews):
+    review_id = int(call.data.split("_")[2])
+    deleted = reviews.pop_id(review_id)
+    if deleted is None:
         await call.answer("Уже удалён")
         return
 
-    deleted = reviews.pop(idx)
     await call.message.edit_text(
         f"Отзыв удалён!\n\n"
         f"От: <b>{deleted.get('username', 'Аноним')}</b>\n"
@@ -2636,35 +5434,6 @@ async def do_delete_review(call: CallbackQuery, state: FSMContext):
     await call.answer("Удалено!")
 
  # ====================== ОДНОРАЗОВАЯ РАССЫЛКА ВСЕМ ======================
-async def one_time_broadcast():
-    # === ИЗМЕНИ ЭТО СООБЩЕНИЕ НА СВОЁ ===
-    text = """Бот вновь функционирует!
-    
-    Из за большой нагрузки на сервера кнопка "Магазин" поломалась.
-    Наша команда работала над этим и исправила все ошибки!"""
-    # =====================================
-
-    if not users:
-        print("❌ Нет пользователей для рассылки.")
-        return
-
-    print(f"🚀 Начинаю рассылку {len(users)} пользователям...")
-    success = 0
-    failed = 0
-
-    for user_id in list(users.keys()):
-        try:
-            await bot.send_message(user_id, text)
-            success += 1
-        except Exception:
-            failed += 1
-        await asyncio.sleep(0.04)  # защита от бана
-
-    print(f"✅ РАССЫЛКА ЗАВЕРШЕНА!")
-    print(f"📤 Успешно: {success}")
-    print(f"❌ Не доставлено: {failed}")
-    print(f"👥 Всего пользователей: {len(users)}")
-    print(f"📊 Процент успеха: {(success/len(users)*100):.1f}%")
 # ====================== MAIN ======================
 async def main():
     logging.basicConfig(level=logging.INFO)
@@ -2673,10 +5442,7 @@ async def main():
         print("Запуск бота... Загрузка данных из базы...")
         await load_all_data()
         print("Данные загружены успешно!")
-        
-        # === РАССЫЛКА ВСЕМ (УБЕРИ ЭТИ 2 СТРОКИ ПОСЛЕ ПЕРВОЙ РАССЫЛКИ ===
-        await one_time_broadcast()
-        # ========================================================
+        ensure_broadcast_runner()   # продолжить рассылки, прерванные остановкой
         
     except Exception as e:
         # ... остальной код без изменений ...
@@ -2685,11 +5451,16 @@ async def main():
         traceback.print_exc()
         print("Бот НЕ МОЖЕТ запуститься без базы. Создаём чистую базу...")
         # Попробуем создать базу заново
-        await init_db()
+        await backend.init()
+        # Журнал мог пережить сбой: без replay ledger.seq начнётся с 1 и id новых записей
+        # столкнутся с уже лежащими в ledger — журнал больше никогда не запишется
+        replayed = await ledger.replay()
+        if replayed:
+            logging.warning(f"Ledger: переиграно {replayed} изменений баланса после аварийной остановки")
         # И добавим хотя бы владельца как админа
         if ADMIN_IDS:
             admins[ADMIN_IDS[0]] = 3
-            await save_dict("admins", admins)
+            await flush_dict("admins", admins)
         print("Пустая база создана, владелец добавлен как админ.")
 
     try:
@@ -2714,7 +5485,12 @@ async def main():
         traceback.print_exc()
     finally:
         print("Останавливаем бота... Сохраняем данные...")
+        await stop_broadcast_runner()
+        await asyncio.gather(*_notify_tasks, return_exceptions=True)
+        await outbox.drain()
+        await ledger.flush()
         await autosave()  # Сохраним на выходе
+        await backend.close()
         await bot.session.close()
         print("Бот остановлен.")
 
@@ -0,0 +1,46 @@
+# Всё, что бот пишет в хранилище, должно идти через backend — проверяем на InMemoryBackend
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main_emoji as bot_main
+
+
+def test_incomplete_backend_fails_at_creation():
+    class Partial(bot_main.StorageBackend):
+        async def count_users(self):
+            return 0
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_archive_and_broadcast_on_memory_backend(monkeypatch):
+    async def scenario():
+        storage = bot_main.use_backend(bot_main.InMemoryBackend())
+        bot_main.users = bot_main.UserRepository(10)
+        for uid in (1, 2):
+            await bot_main.users.create(uid, bot_main.new_user_profile())
+
+        old = datetime.now() - timedelta(days=bot_main.ARCHIVE_AFTER_DAYS + 1)
+        bot_main.tickets[5] = {"user_id": 1, "open": False, "closed_at": old}
+        await bot_main.add_ticket_message(5, "user", "hi", "01.01")
+        assert await bot_main.archive_old_records() == (1, 0)
+        archived = await bot_main.load_archived_ticket(5)
+        assert archived["messages"] == [{"from": "user", "text": "hi", "date": "01.01"}]
+        assert 5 not in bot_main.tickets and not storage.messages
+
+        async def fake_send(user_id, unreachable_at, method, text, **kwargs):
+            return True
+        monkeypatch.setattr(bot_main, "bulk_send", fake_send)
+        await bot_main.start_broadcast("hello")
+        await bot_main._broadcast_task
+        job = await bot_main.get_broadcast_job()
+        assert (job["status"], job["sent"], job["cursor"]) == ("done", 2, 2)
+
+    asyncio.run(scenario())
@@ -0,0 +1,80 @@
+# Профиль, вытесненный из LRU посреди хендлера, не должен терять запись в него
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main_emoji as bot_main
+
+
+def _setup(max_size: int):
+    bot_main.use_backend(bot_main.InMemoryBackend())
+    bot_main.users = bot_main.UserRepository(max_size)
+
+
+def test_write_after_eviction_reaches_storage():
+    async def scenario():
+        _setup(max_size=2)
+        await bot_main.users.create(1, bot_main.new_user_profile("one", "One"))
+        user = await bot_main.users.get(1)          # хендлер держит профиль...
+        for uid in (2, 3, 4):                       # ...а другие апдейты его вытесняют
+            await bot_main.users.create(uid, bot_main.new_user_profile())
+        assert not dict.__contains__(bot_main.users.cache, 1)
+
+        bot_main.change_balance(1, user, "balance", 100, "test")
+        user["purchases"].append({"product": 1})
+        assert await bot_main.users.get(1) is user  # тот же объект, не копия из БД
+
+        await bot_main.users.flush()
+        await bot_main.ledger.flush()
+        bot_main.users = bot_main.UserRepository(2)
+        stored = await bot_main.users.get(1)
+        assert stored["balance"] == 100
+        assert stored["purchases"] == [{"product": 1}]
+
+    asyncio.run(scenario())
+
+
+def test_reads_do_not_flush_dirty_users():
+    async def scenario():
+        _setup(max_size=10)
+        await bot_main.users.create(1, bot_main.new_user_profile())
+        user = await bot_main.users.get(1)
+        user["unreachable_at"] = 123
+
+        assert await bot_main.users.count() == 1
+        assert await bot_main.users.reach_after(0, 10) == [(1, 123)]
+        assert 1 in bot_main.users.cache._dirty     # правка всё ещё ждёт автосейва
+
+    asyncio.run(scenario())
+
+
+def test_victim_dirtied_during_writeback_stays_evictable():
+    async def scenario():
+        _setup(max_size=2)
+        await bot_main.users.create(1, bot_main.new_user_profile())
+        user = await bot_main.users.get(1)
+        storage = bot_main.backend
+        original = storage.write_users
+
+        async def write_users(full_rows, partial, deleted):
+            await original(full_rows, partial, deleted)
+            user["name"] = "changed"      # хендлер правит профиль, пока идёт запись вытеснения
+
+        storage.write_users = write_users
+        for uid in (2, 3):
+            await bot_main.users.create(uid, bot_main.new_user_profile())
+        storage.write_users = original
+
+        assert 1 in bot_main.users._lru   # остался в кэше — значит, и в LRU
+        for uid in (4, 5, 6):
+            await bot_main.users.create(uid, bot_main.new_user_profile())
+        assert len(bot_main.users._lru) <= 2
+        assert not dict.__contains__(bot_main.users.cache, 1)
+
+        await bot_main.users.flush()
+        bot_main.users = bot_main.UserRepository(2)
+        assert (await bot_main.users.get(1))["name"] == "changed"
+
+    asyncio.run(scenario())